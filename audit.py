@@ -0,0 +1,49 @@
+"""Fully verifies the chain stored by a node.
+
+Checks the hash links, proofs of work and transfer signatures of every
+block in ``blockchain-<port>.db`` on all cores. Progress is saved as
+segments verify, so an interrupted audit continues where it stopped.
+
+    python audit.py -p 5000
+    python audit.py -p 5000 --restart
+
+The exit status is 1 if an invalid block was found.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+from blob_store import BlobStore
+from storage import Storage
+from utility.hash_util import hash_block
+from utility.verification import SEGMENT_SIZE, Verification
+
+
+def audit(storage, restart=False, segment_size=SEGMENT_SIZE):
+    """Returns the index of the first invalid stored block or None."""
+    start = 0 if restart else storage.load_audit_progress()
+    blocks = storage.load_chain()
+    if start:
+        print('Resuming the audit after block {}'.format(start))
+
+    def save_progress(block):
+        storage.save_audit_progress(block.index, hash_block(block))
+        print('Verified up to block {} of {}'.format(block.index, len(blocks) - 1))
+
+    return Verification.find_invalid_block(blocks[start:], save_progress, segment_size)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Verify every block stored by a node.')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--restart', action='store_true', help='ignore the progress of earlier audits')
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE,
+                        help='blocks verified per task on the process pool')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    invalid_height = audit(Storage(args.port, BlobStore(args.port)), args.restart, args.segment_size)
+    if invalid_height is not None:
+        print('Block {} is invalid'.format(invalid_height))
+        sys.exit(1)
+    print('The chain is valid ({:.2f}s)'.format(time.perf_counter() - started))
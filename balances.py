@@ -0,0 +1,57 @@
+from collections import Counter
+
+
+class BalanceIndex:
+    """Per-participant file counters behind Blockchain.get_balance.
+
+    Confirmed transfers are counted once when their block is appended and
+    open transfers while they sit in the mempool, so a balance query is a
+    few dict lookups instead of a walk over the whole chain.
+    """
+
+    def __init__(self):
+        self.sent = Counter()
+        self.received = Counter()
+        self.open_sent = Counter()
+
+    def rebuild(self, chain, open_transfers, snapshot=None):
+        """Recounts ``chain`` and ``open_transfers``, on top of the counts
+        in ``snapshot`` if given."""
+        self.sent.clear()
+        self.received.clear()
+        self.open_sent.clear()
+        if snapshot is not None:
+            self.sent.update(snapshot['sent'])
+            self.received.update(snapshot['received'])
+        for block in chain:
+            self.add_block(block)
+        for tx in open_transfers:
+            self.add_open_transfer(tx)
+
+    def add_block(self, block):
+        for tx in block.transfers:
+            self.sent[tx.sender] += 1
+            self.received[tx.recipient] += 1
+
+    def remove_block(self, block):
+        for tx in block.transfers:
+            self.sent[tx.sender] -= 1
+            self.received[tx.recipient] -= 1
+
+    def add_open_transfer(self, transfer):
+        self.open_sent[transfer.sender] += 1
+
+    def remove_open_transfer(self, transfer):
+        self.open_sent[transfer.sender] -= 1
+        if self.open_sent[transfer.sender] <= 0:
+            del self.open_sent[transfer.sender]
+
+    def snapshot(self):
+        """Returns the confirmed counts in a JSON serializable form."""
+        return {
+            'sent': {key: count for key, count in self.sent.items() if count},
+            'received': {key: count for key, count in self.received.items() if count}
+        }
+
+    def get_balance(self, participant):
+        return self.received[participant] + self.sent[participant] + self.open_sent[participant]
@@ -0,0 +1,306 @@
+"""Benchmarks for the chain, mining and storage hot paths.
+
+Builds a synthetic chain in a temporary directory, times the hot paths on
+it and prints the results as JSON. With ``--baseline`` the medians are
+compared against an earlier result and the exit status is 1 if anything
+got slower than the tolerance allows.
+
+    python benchmark.py --blocks 50 --transfers 8 --payload 4096 -o new.json
+    python benchmark.py --baseline new.json
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+NODE_ID = 'bench'
+PEER_ID = 'bench-peer'
+
+
+def measure(fn, repeat, setup=None):
+    """Calls ``fn`` ``repeat`` times and returns the durations in seconds.
+
+    ``setup`` runs before every call and is not timed.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations, per=1):
+    """Returns the statistics of ``durations``, each divided by ``per``
+    operations."""
+    durations = [d / per for d in durations]
+    return {
+        'runs': len(durations),
+        'ops_per_run': per,
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'mean': statistics.mean(durations),
+        'max': max(durations)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns ``(name, baseline median, new median, ratio)`` for every
+    benchmark that got slower than ``1 + tolerance`` times the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], result['median']
+        ratio = new / old if old else float('inf')
+        print('{:<24} {:>12.6f} {:>12.6f} {:>7.2f}x'.format(name, old, new, ratio), file=sys.stderr)
+        if ratio > 1 + tolerance:
+            regressions.append((name, old, new, ratio))
+    return regressions
+
+
+class ChainBenchmark:
+    """Builds a synthetic chain and times the operations on it.
+
+    Every block gets ``transfers`` signed transfers between ``keys`` real
+    RSA key pairs, each one carrying a random payload of ``payload`` bytes,
+    plus the mining reward.
+    """
+
+    def __init__(self, blocks, transfers, payload, keys, repeat, seed):
+        self.blocks = blocks
+        self.transfers = transfers
+        self.payload = payload
+        self.keys = keys
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.results = {}
+
+    def run(self):
+        from users import User
+        print('Generating {} key pairs'.format(self.keys), file=sys.stderr)
+        self.users = []
+        for node_id in range(self.keys):
+            user = User(node_id)
+            user.private_key, user.public_key = User.generate_keys()
+            self.users.append(user)
+
+        self.bench_build()
+        self.bench_proof_of_work()
+        self.bench_add_block()
+        self.bench_load_data()
+        self.bench_append_block()
+        self.bench_get_balance()
+        self.bench_verify_chain()
+        self.bench_hash_block()
+        self.bench_chain_endpoint()
+        self.bench_download()
+        return self.results
+
+    def payload_bytes(self):
+        return bytes(self.random.getrandbits(8) for _ in range(self.payload))
+
+    def add_transfers(self, blockchain, count):
+        for _ in range(count):
+            sender, recipient = self.random.sample(self.users, 2)
+            file_name = 'file-{}.bin'.format(self.random.getrandbits(64))
+            file_hash, file_size = blockchain.blobs.put(self.payload_bytes())
+            signature = sender.sign_transfer(sender.public_key, recipient.public_key, file_name, file_hash)
+            blockchain.add_transfer(recipient.public_key, sender.public_key, file_name,
+                                    file_hash, file_size, signature)
+
+    def mine(self, blockchain):
+        file_hash, file_size = blockchain.blobs.put(self.payload_bytes())
+        return blockchain.mine_block(file_hash, 'reward-{}.bin'.format(len(blockchain.chain)), file_size)
+
+    def bench_build(self):
+        from blockchain import Blockchain
+        print('Building a chain of {} blocks'.format(self.blocks), file=sys.stderr)
+        self.blockchain = Blockchain(self.users[0].public_key, NODE_ID)
+        durations = []
+        for _ in range(self.blocks):
+            self.add_transfers(self.blockchain, self.transfers)
+            durations.extend(measure(lambda: self.mine(self.blockchain), 1))
+        self.results['mine_block'] = summarize(durations)
+
+    def bench_proof_of_work(self):
+        self.add_transfers(self.blockchain, self.transfers)
+        self.results['proof_of_work'] = summarize(measure(self.blockchain.proof_of_work, self.repeat))
+
+    def bench_add_block(self):
+        """Replays the chain on a second node with cold signature caches,
+        like a node that receives blocks it has not seen the transfers of."""
+        import users
+        from blockchain import Blockchain
+        peer = Blockchain(self.users[1].public_key, PEER_ID)
+        blocks = self.blockchain.get_blocks(1)
+        paths = [self.blockchain.get_payload_paths(block.transfers) for block in blocks]
+        payloads = [{file_hash: self.blockchain.blobs.get(file_hash) for file_hash in block_paths}
+                    for block_paths in paths]
+        users.import_public_key.cache_clear()
+        users._verified.clear()
+        durations = []
+        for block, files in zip(blocks, payloads):
+            durations.extend(measure(lambda: peer.add_block(block.to_dict(), files), 1))
+        if len(peer.chain) != len(self.blockchain.chain):
+            raise RuntimeError('The peer rejected a block of the synthetic chain')
+        self.results['add_block'] = summarize(durations)
+
+    def bench_load_data(self):
+        self.results['load_data'] = summarize(measure(self.blockchain.load_data, self.repeat))
+
+    def bench_append_block(self):
+        """Times storing a new block on top of the tip, the write mine_block
+        and add_block do. The block is dropped again before every run and
+        after the last one, so the chain is left as it was."""
+        import hashlib
+        from block import Block
+        from transfer import Transfer
+        tip = self.blockchain.get_last_blockchain_value()
+        transfers = []
+        for _ in range(self.transfers):
+            sender, recipient = self.random.sample(self.users, 2)
+            file_name = 'file-{}.bin'.format(self.random.getrandbits(64))
+            file_hash = hashlib.sha256(self.payload_bytes()).hexdigest()
+            signature = sender.sign_transfer(sender.public_key, recipient.public_key, file_name, file_hash)
+            transfers.append(Transfer(sender.public_key, recipient.public_key, signature,
+                                      file_hash, file_name, self.payload))
+        transfers.append(Transfer('SYSTEM', self.users[0].public_key, '',
+                                  hashlib.sha256(self.payload_bytes()).hexdigest(), 'reward.bin', self.payload))
+        block = Block(tip.index + 1, tip.hash, transfers, 0)
+        storage = self.blockchain.storage
+
+        def drop_block():
+            storage.replace_blocks_from(block.index, [])
+
+        self.results['append_block'] = summarize(
+            measure(lambda: storage.append_block(block), self.repeat, drop_block))
+        drop_block()
+
+    def bench_get_balance(self):
+        keys = [user.public_key for user in self.users]
+        self.results['get_balance'] = summarize(
+            measure(lambda: [self.blockchain.get_balance(key) for key in keys], self.repeat), len(keys))
+
+    def bench_verify_chain(self):
+        from utility.verification import Verification
+        chain = self.blockchain.chain
+        self.results['verify_chain'] = summarize(
+            measure(lambda: Verification.verify_chain(chain), self.repeat))
+
+    def bench_hash_block(self):
+        """Hashes freshly loaded blocks, so the cached hash is not used."""
+        from block import Block
+        from utility.hash_util import hash_block
+        dicts = [block.to_dict() for block in self.blockchain.chain]
+        copies = []
+
+        def setup():
+            copies[:] = [Block.from_dict(block) for block in dicts]
+
+        self.results['hash_block'] = summarize(
+            measure(lambda: [hash_block(block) for block in copies], self.repeat, setup), len(dicts))
+
+    def bench_chain_endpoint(self):
+        client = self.client()
+        import index
+
+        def get_chain():
+            response = client.get('/chain')
+            if response.status_code != 200:
+                raise RuntimeError('/chain answered {}'.format(response.status_code))
+
+        self.results['chain_endpoint'] = summarize(
+            measure(get_chain, self.repeat, index.response_cache.clear))
+        self.results['chain_endpoint_cached'] = summarize(measure(get_chain, self.repeat))
+
+    def bench_download(self):
+        client = self.client()
+        names = [tx.file_name for block in self.blockchain.get_blocks(1) for tx in block.transfers]
+        sample = self.random.sample(names, min(len(names), 32))
+
+        def download():
+            for name in sample:
+                response = client.get('/download/' + name)
+                if response.status_code != 200 or len(response.data) != self.payload:
+                    raise RuntimeError('Downloading {} failed'.format(name))
+
+        self.results['download'] = summarize(measure(download, self.repeat), len(sample))
+
+    def client(self):
+        import index
+        index.port = NODE_ID
+        index.user = self.users[0]
+        index.blockchain = self.blockchain
+        return index.app.test_client()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the chain, mining and storage hot paths.')
+    parser.add_argument('--blocks', type=int, default=20, help='number of blocks to build')
+    parser.add_argument('--transfers', type=int, default=4, help='transfers per block')
+    parser.add_argument('--payload', type=int, default=1024, help='payload size in bytes')
+    parser.add_argument('--keys', type=int, default=4, help='number of RSA key pairs')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline, e.g. 0.2 for 20%%')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, root)
+    workdir = tempfile.mkdtemp(prefix='blockchain-bench-')
+    os.chdir(workdir)
+    try:
+        results = ChainBenchmark(args.blocks, args.transfers, args.payload,
+                                 args.keys, args.repeat, args.seed).run()
+    finally:
+        from database import close_all
+        close_all()
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'parameters': {
+            'blocks': args.blocks,
+            'transfers': args.transfers,
+            'payload': args.payload,
+            'keys': args.keys,
+            'repeat': args.repeat,
+            'seed': args.seed
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'timestamp': time.time(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != report['parameters']:
+            print('Warning: the baseline was taken with different parameters', file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for name, old, new, ratio in regressions:
+            print('Regression: {} took {:.6f}s, baseline {:.6f}s ({:.2f}x)'.format(name, new, old, ratio),
+                  file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,194 @@
+"""Content-addressed storage for transferred files."""
+
+import hashlib as hl
+import os
+import tempfile
+import threading
+
+from utility.hash_util import is_digest
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    """Keeps every file payload once, on disk, keyed by its SHA-256 digest.
+
+    Blobs live in ``blobs-<node_id>/<first two hex chars>/<digest>``.
+    Transfers and blocks only reference the digest, so identical files
+    uploaded several times share a single blob.
+
+    A blob that is about to be referenced, stored but not yet part of a
+    transfer or block, is held (stored with ``hold=True`` or passed to
+    ``hold``) and is not deleted until it is released.
+    """
+
+    def __init__(self, node_id):
+        self.path = 'blobs-{}'.format(node_id)
+        os.makedirs(self.path, exist_ok=True)
+        self.__size = None
+        self.__size_lock = threading.Lock()
+        self.__holds = {}
+        self.__holds_lock = threading.Lock()
+
+    def blob_path(self, file_hash):
+        """Returns the path of a blob. Raises ValueError if ``file_hash``
+        is not a digest, as it may come from a peer."""
+        if not is_digest(file_hash):
+            raise ValueError('Not a SHA-256 digest: {!r}'.format(file_hash))
+        return os.path.join(self.path, file_hash[:2], file_hash)
+
+    def has(self, file_hash):
+        return is_digest(file_hash) and os.path.isfile(self.blob_path(file_hash))
+
+    def file_size(self, file_hash):
+        """Returns the size of a stored blob or None."""
+        if not is_digest(file_hash):
+            return None
+        try:
+            return os.path.getsize(self.blob_path(file_hash))
+        except OSError:
+            return None
+
+    def put(self, data, hold=False):
+        """Stores ``data`` and returns its ``(file_hash, file_size)``."""
+        file_hash = hl.sha256(data).hexdigest()
+        self._store(file_hash, data, hold)
+        return file_hash, len(data)
+
+    def put_verified(self, data, file_hash, hold=False):
+        """Stores ``data`` only if it matches the expected digest."""
+        if hl.sha256(data).hexdigest() != file_hash:
+            return False
+        self._store(file_hash, data, hold)
+        return True
+
+    def put_stream(self, stream, file_hash=None, hold=False):
+        """Spools a file-like object to disk in fixed-size chunks.
+
+        See ``put_chunks``.
+        """
+        return self.put_chunks(iter(lambda: stream.read(CHUNK_SIZE), b''), file_hash, hold)
+
+    def put_chunks(self, chunks, file_hash=None, hold=False):
+        """Stores an iterable of byte chunks with bounded memory.
+
+        The digest is computed while the chunks are written to a temporary
+        file, which is then moved into place. Returns ``(file_hash,
+        file_size)``, or None if ``file_hash`` was given and does not match.
+        """
+        tmp_path, actual_hash, file_size = self._spool(chunks)
+        try:
+            if file_hash is not None and actual_hash != file_hash:
+                return None
+            self._place(tmp_path, actual_hash, file_size, hold)
+            return actual_hash, file_size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def hold(self, file_hash):
+        """Keeps a stored blob from being deleted until it is released.
+        Returns False, holding nothing, if the blob is not stored."""
+        with self.__holds_lock:
+            if not self.has(file_hash):
+                return False
+            self.__holds[file_hash] = self.__holds.get(file_hash, 0) + 1
+            return True
+
+    def release(self, file_hash):
+        with self.__holds_lock:
+            count = self.__holds.get(file_hash, 0) - 1
+            if count > 0:
+                self.__holds[file_hash] = count
+            else:
+                self.__holds.pop(file_hash, None)
+
+    def spool(self, chunks, file_hash):
+        """Writes byte chunks to a temporary file outside of the store.
+
+        Returns the path of the file, which the caller has to remove, or
+        None if the content does not match ``file_hash``.
+        """
+        tmp_path, actual_hash, _ = self._spool(chunks)
+        if actual_hash != file_hash:
+            os.remove(tmp_path)
+            return None
+        return tmp_path
+
+    def _spool(self, chunks):
+        digest = hl.sha256()
+        file_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    file_size += len(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), file_size
+
+    def get(self, file_hash):
+        if not self.has(file_hash):
+            return None
+        with open(self.blob_path(file_hash), 'rb') as f:
+            return f.read()
+
+    def delete(self, file_hash):
+        """Removes a blob that is not held and returns the number of bytes
+        freed."""
+        if not is_digest(file_hash):
+            return 0
+        path = self.blob_path(file_hash)
+        with self.__holds_lock:
+            if file_hash in self.__holds:
+                return 0
+            try:
+                file_size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return 0
+        self._grow(-file_size)
+        return file_size
+
+    def size_bytes(self):
+        """Returns the size of all blobs. The store is walked once, after
+        that the total is kept up to date on every write and delete."""
+        with self.__size_lock:
+            if self.__size is None:
+                self.__size = sum(entry.stat().st_size
+                                  for directory in os.scandir(self.path) if directory.is_dir()
+                                  for entry in os.scandir(directory.path) if entry.is_file())
+            return self.__size
+
+    def _grow(self, file_size):
+        with self.__size_lock:
+            if self.__size is not None:
+                self.__size += file_size
+
+    def _store(self, file_hash, data, hold):
+        if self.hold(file_hash) if hold else self.has(file_hash):
+            return
+        directory = os.path.dirname(self.blob_path(file_hash))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._place(tmp_path, file_hash, len(data), hold)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _place(self, tmp_path, file_hash, file_size, hold):
+        """Moves a written file into place, unless the blob is stored
+        already, and holds it if asked to."""
+        with self.__holds_lock:
+            if not self.has(file_hash):
+                os.makedirs(os.path.dirname(self.blob_path(file_hash)), exist_ok=True)
+                os.replace(tmp_path, self.blob_path(file_hash))
+                self._grow(file_size)
+            if hold:
+                self.__holds[file_hash] = self.__holds.get(file_hash, 0) + 1
@@ -1,12 +1,80 @@
 from time import time
 
+from transfer import Transfer
+from utility.hash_util import hash_header, hash_legacy_block, merkle_root
 from utility.printable import Printable
 
+BLOCK_VERSION = 1
+
 
 class Block(Printable):
-    def __init__(self, index, previous_hash, transfers, proof, time=time()):
+    """A block of the blockchain.
+
+    Version 1 blocks commit to their transfers through ``merkle_root`` and
+    are hashed by their compact header only. Version 0 blocks were created
+    before headers existed and are hashed as a whole, base64 payloads
+    included. Their payloads have moved to the blob store since, so their
+    hash can only be the one recorded when the local database was
+    migrated, see ``Storage.load_chain``.
+    """
+    __slots__ = ('index', 'previous_hash', 'timestamp', 'transfers', 'proof', 'version',
+                 'merkle_root', '__hash')
+
+    def __init__(self, index, previous_hash, transfers, proof, timestamp=None,
+                 version=BLOCK_VERSION, merkle_root=None):
         self.index = index
         self.previous_hash = previous_hash
-        self.timestamp = time
+        self.timestamp = time() if timestamp is None else timestamp
         self.transfers = transfers
         self.proof = proof
+        self.version = version
+        self.merkle_root = merkle_root if merkle_root is not None else self.compute_merkle_root()
+        self.__hash = None
+
+    @classmethod
+    def from_dict(cls, block, trusted=False):
+        """Creates a block from its dict form (e.g. parsed JSON).
+
+        With ``trusted`` the ``hash`` stored next to an already verified
+        block is taken as is instead of being recomputed. It must never be
+        set for a block from a peer.
+        """
+        new_block = cls(block['index'],
+                        block['previous_hash'],
+                        [Transfer.from_dict(tx) for tx in block['transfers']],
+                        block['proof'],
+                        block['timestamp'],
+                        block.get('version', 0),
+                        block.get('merkle_root'))
+        if trusted:
+            new_block.__hash = block['hash']
+        return new_block
+
+    def compute_merkle_root(self):
+        return merkle_root(self.transfers)
+
+    def header(self):
+        return {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'merkle_root': self.merkle_root,
+            'proof': self.proof,
+            'version': self.version
+        }
+
+    @property
+    def hash(self):
+        """The block hash, computed once and cached."""
+        if self.__hash is None:
+            if self.version == 0:
+                self.__hash = hash_legacy_block(self)
+            else:
+                self.__hash = hash_header(self.header())
+        return self.__hash
+
+    def to_dict(self):
+        """Converts this block into a JSON serializable dict."""
+        dict_block = self.header()
+        dict_block['transfers'] = [tx.to_dict() for tx in self.transfers]
+        return dict_block
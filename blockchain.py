@@ -1,138 +1,151 @@
-import json
 import requests
-import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
-from utility.hash_util import hash_block
+from utility.hash_util import hash_block, hash_transfer, is_digest
+from utility.mining import ProofOfWork, header_prefix
+from utility.rwlock import ReadWriteLock
 from utility.verification import Verification
+from balances import BalanceIndex
+from blob_store import BlobStore, CHUNK_SIZE
 from block import Block
+from broadcaster import broadcaster, MAX_WORKERS
+from events import EventBus
+from gossip import Gossip
+from mempool import Mempool, MAX_BYTES, MAX_TRANSFERS
+from metrics import Counter, Histogram
+from pruner import Pruner
+from storage import Storage
 from transfer import Transfer
 from users import User
+from wire import Message
+
+MINE_PHASE_SECONDS = Histogram('blockchain_mine_phase_seconds', 'Time spent in each phase of mining a block.',
+                               ['phase'])
+BLOCKS = Counter('blockchain_blocks_total', 'Blocks mined, received or synced by outcome.',
+                 ['source', 'result'])
+TRANSFERS = Counter('blockchain_transfers_total', 'Transfers offered to the mempool by outcome.', ['result'])
+PAYLOAD_FETCHES = Counter('payload_fetches_total', 'Pruned payloads fetched from peers by outcome.', ['result'])
+
+CHECKPOINT_INTERVAL = 100
 
 
 class Blockchain:
-    def __init__(self, public_key, node_id):
-        genesis_block = Block(0, '', [], 100, 0)
+    """The chain, the mempool and the peers of a node.
+
+    ``lock`` guards the in-memory state: request handlers read under the
+    read lock while appending a block, changing the mempool or replacing
+    part of the chain happen under the write lock. Proof of work,
+    signature checks and network calls run outside of it.
+
+    Every ``CHECKPOINT_INTERVAL`` blocks the verified tip and the balances
+    are checkpointed, so loading only verifies and recounts the blocks
+    after ``checkpoint_height``.
+
+    With ``prune_depth`` or ``prune_bytes`` the node is pruned (see
+    Pruner) and fetches old payloads from ``archive_nodes`` or its peers
+    when they are asked for.
+
+    Changes are published on ``events`` (see events.py) while the write
+    lock is held, so they come out in the order they were applied.
+    """
+
+    def __init__(self, public_key, node_id, max_open_transfers=MAX_TRANSFERS, max_open_bytes=MAX_BYTES,
+                 prune_depth=None, prune_bytes=None, archive_nodes=()):
+        self.lock = ReadWriteLock()
+        genesis_block = Block(0, '', [], 100, 0, version=0)
         self.chain = [genesis_block]
-        self.__open_transfers = []
+        self.__open_transfers = Mempool(max_open_transfers, max_open_bytes)
         self.public_key = public_key
         self.__peer_nodes = set()
         self.node_id = node_id
         self.resolve_conflicts = False
+        self.blobs = BlobStore(node_id)
+        self.storage = Storage(node_id, self.blobs)
+        self.pow = ProofOfWork()
+        self.balances = BalanceIndex()
+        self.checkpoint_height = 0
+        self.pruner = Pruner(self.storage, self.blobs, self.lock, prune_depth, prune_bytes)
+        self.archive_nodes = list(archive_nodes)
+        self.gossip = Gossip(self)
+        self.events = EventBus()
 
         self.load_data()
+        self.pruner.schedule(self.get_last_blockchain_value().index)
 
     @property
     def chain(self):
-        return self.__chain[:]
+        with self.lock.read():
+            return self.__chain[:]
 
     @chain.setter
     def chain(self, val):
         self.__chain = val
 
-    def get_open_transfers(self):
-        return self.__open_transfers[:]
+    def get_open_transfer(self, signature):
+        with self.lock.read():
+            return self.__open_transfers.get(signature)
+
+    def get_open_transfers(self, start=0, stop=None):
+        with self.lock.read():
+            return self.__open_transfers.get_range(start, stop)
+
+    def get_mempool_size(self):
+        """Returns the number of open transfers and the bytes of their files."""
+        with self.lock.read():
+            return len(self.__open_transfers), self.__open_transfers.size_bytes
 
     def get_last_blockchain_value(self):
-        if len(self.__chain) < 1:
-            return None
-        return self.__chain[-1]
-
-    def save_data(self):
-        saveable_chain = [
-            block.__dict__ for block in
-            [
-                Block(block_el.index,
-                      block_el.previous_hash,
-                      [tx.__dict__ for tx in block_el.transfers],
-                      block_el.proof,
-                      block_el.timestamp) for block_el in self.__chain
-            ]
-        ]
-
-        conn = sqlite3.connect('blockchain-{}.db'.format(self.node_id))
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            INSERT INTO peer_nodes (node_url) 
-            VALUES (?)
-        ''', (json.dumps(list(self.__peer_nodes)),))
-
-        for block_data in saveable_chain:
-            cursor.execute('''
-                INSERT INTO blockchain (block_data) 
-                VALUES (?)
-            ''', (json.dumps(block_data),))
-
-        for tx in self.__open_transfers:
-            cursor.execute('''
-                INSERT INTO open_transfers (sender, recipient, file_name, file, signature) 
-                VALUES (?, ?, ?, ?, ?)
-            ''', (tx.sender, tx.recipient, tx.file_name, tx.file, tx.signature))
-        conn.commit()
+        with self.lock.read():
+            if len(self.__chain) < 1:
+                return None
+            return self.__chain[-1]
 
     def load_data(self):
+        with self.lock.write():
+            self.__load_data()
+            self.events.publish('reset', {})
+
+    def __load_data(self):
         self.chain = []
-        self.__open_transfers = []
-
-        conn = sqlite3.connect('blockchain-{}.db'.format(self.node_id))
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS peer_nodes (
-                node_id INTEGER PRIMARY KEY,
-                node_url TEXT
-            )
-        ''')
-
-        cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS blockchain (
-                        block_id INTEGER PRIMARY KEY,
-                        block_data TEXT
-                    )
-                ''')
-
-        cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS open_transfers (
-                        transfer_id INTEGER PRIMARY KEY,
-                        sender TEXT,
-                        recipient TEXT,
-                        file_name TEXT,
-                        file BLOB,
-                        signature TEXT
-                    )
-                ''')
-
-        conn.commit()
-
-        data = cursor.execute('SELECT node_url FROM peer_nodes')
-        peer_nodes_data = data.fetchone()
-        if peer_nodes_data:
-            peer_nodes = json.loads(peer_nodes_data[0])
-            self.__peer_nodes = set(peer_nodes)
-
-        data = cursor.execute('SELECT block_data FROM blockchain')
-        block_data = data.fetchall()
-        if block_data:
-            for row in block_data:
-                block = json.loads(row[0])
-                if not any(b.index == block['index'] for b in self.__chain):
-                    block_instance = Block(
-                        index=block['index'],
-                        previous_hash=block['previous_hash'],
-                        transfers=[Transfer(**tx) for tx in block['transfers']],
-                        proof=block['proof']
-                    )
-                    self.__chain.append(block_instance)
+        self.__open_transfers.clear()
+
+        self.__peer_nodes = set(self.storage.load_peer_nodes())
+
+        checkpoint = self.storage.load_checkpoint()
+        self.checkpoint_height = checkpoint['height'] if checkpoint is not None else 0
+        self.__chain = self.storage.load_chain(self.checkpoint_height)
+        if not self.__chain:
+            genesis_block = Block(0, 'genesis_previous_hash', [], 0, 0, version=0)
+            self.__chain = [genesis_block]
+            self.storage.append_block(genesis_block)
+
+        evicted = []
+        for tx in self.storage.load_open_transfers():
+            evicted.extend(self.__open_transfers.add(Transfer.from_dict(tx)) or [])
+        if evicted:
+            self.storage.remove_open_transfers([tx.signature for tx in evicted])
+            self.__discard_payloads(evicted)
+
+        if checkpoint is not None:
+            self.balances.rebuild(self.__chain[self.checkpoint_height + 1:], self.__open_transfers,
+                                  checkpoint['balances'])
         else:
-            self.__chain = [Block(0, 'genesis_previous_hash', [], 0, 0)]
+            self.balances.rebuild(self.__chain, self.__open_transfers)
 
-        data = cursor.execute('SELECT * FROM open_transfers')
-        rows = data.fetchall()
-        if rows:
-            for row in rows:
-                self.__open_transfers.append(Transfer(sender=row[1], recipient=row[2], file_name=row[3], file=row[4], signature=row[5]))
-
-        conn.close()
+        if Verification.verify_chain(self.__chain, self.checkpoint_height):
+            self.__checkpoint(interval=1)
+        else:
+            print('The stored chain does not verify after height {}'.format(self.checkpoint_height))
+
+    def __checkpoint(self, interval=CHECKPOINT_INTERVAL):
+        """Checkpoints the tip once it is ``interval`` blocks past the last
+        checkpoint. Only called with verified blocks and the write lock
+        held."""
+        tip = self.__chain[-1]
+        if tip.index - self.checkpoint_height < interval:
+            return
+        self.storage.save_checkpoint(tip.index, hash_block(tip), self.balances.snapshot())
+        self.checkpoint_height = tip.index
 
     def get_balance(self, sender=None):
         if sender is None:
@@ -142,187 +155,490 @@ class Blockchain:
         else:
             participant = sender
 
-        tx_sender = [[tx.file for tx in block.transfers if tx.sender == participant] for block in self.__chain]
-
-        open_tx_sender = [tx.file for tx in self.__open_transfers if tx.sender == participant]
-        tx_sender.append(open_tx_sender)
-
-        count_files_sent = sum(len(tx_amt) for tx_amt in tx_sender)
-
-        tx_recipient = [[tx.file for tx in block.transfers if tx.recipient == participant] for block in self.__chain]
-
-        count_files_received = sum(len(tx_amt) for tx_amt in tx_recipient)
+        with self.lock.read():
+            return self.balances.get_balance(participant)
 
-        return count_files_received + count_files_sent
-
-    def mine_block(self, file, file_name):
+    def mine_block(self, file_hash, file_name, file_size):
         if self.public_key is None:
             return None
-        last_block = self.__chain[-1]
-
+        held = []
+        with self.lock.read():
+            last_block = self.__chain[-1]
+            # Payloads are held for the search, an evicted transfer would
+            # otherwise lose its payload before the block is stored
+            copied_transfers = []
+            for tx in self.__open_transfers:
+                if self.blobs.hold(tx.file_hash):
+                    held.append(tx.file_hash)
+                    copied_transfers.append(tx)
+        try:
+            return self.__mine_on(last_block, copied_transfers, file_hash, file_name, file_size)
+        finally:
+            for payload in held:
+                self.release_payload(payload)
+
+    def __mine_on(self, last_block, copied_transfers, file_hash, file_name, file_size):
         hashed_block = hash_block(last_block)
-        proof = self.proof_of_work()
-        reward_transfer = Transfer('SYSTEM', self.public_key, '', file, file_name)
-
-        copied_transfers = self.__open_transfers[:]
-        for tx in copied_transfers:
-            if not User.verify_transfer(tx):
-                return None
+        with MINE_PHASE_SECONDS.time(phase='verify'):
+            verified = User.verify_transfers(copied_transfers)
+        if not all(verified):
+            self.discard_open_transfers(
+                [tx for tx, is_valid in zip(copied_transfers, verified) if not is_valid])
+            copied_transfers = [tx for tx, is_valid in zip(copied_transfers, verified) if is_valid]
+        reward_transfer = Transfer('SYSTEM', self.public_key, '', file_hash, file_name, file_size)
         copied_transfers.append(reward_transfer)
+        block = Block(last_block.index + 1, hashed_block, copied_transfers, None)
+        with MINE_PHASE_SECONDS.time(phase='proof_of_work'):
+            proof = self.pow.search(header_prefix(block.header()))
 
-        block = Block(
-            len(self.__chain),
-            hashed_block,
-            copied_transfers,
-            proof
-        )
-
-        conn = sqlite3.connect('blockchain-{}.db'.format(self.node_id))
-        cursor = conn.cursor()
-        for tx in copied_transfers:
-            cursor.execute('''
-                DELETE FROM open_transfers
-                WHERE sender = ? AND recipient = ? AND file_name = ? AND file = ? AND signature = ?
-            ''', (tx.sender, tx.recipient, tx.file_name, tx.file, tx.signature))
-        conn.commit()
-        conn.close()
-        self.__chain.append(block)
-        self.__open_transfers = []
-        self.save_data()
-
-        for node in self.__peer_nodes:
-            url = f'http://{node}/broadcast-block'
-            converted_block = block.__dict__.copy()
-            converted_block['transfers'] = [tx.__dict__ for tx in converted_block['transfers']]
-            try:
-                response = requests.post(url, json={'block': converted_block})
-                if response.status_code == 400 or 500:
-                    print('Block declined, needs resolving')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                continue
+        with self.lock.write():
+            if proof is None or self.__chain[-1] is not last_block:
+                BLOCKS.inc(source='mined', result='abandoned')
+                return None
+            block.proof = proof
+
+            with MINE_PHASE_SECONDS.time(phase='storage'):
+                self.storage.append_block(block)
+            self.__chain.append(block)
+            self.balances.add_block(block)
+            removed = self.__open_transfers.remove(tx.signature for tx in copied_transfers[:-1])
+            for tx in removed:
+                self.balances.remove_open_transfer(tx)
+            self.__checkpoint()
+            self.__publish_block(block)
+            self.__publish_removed(removed)
+            BLOCKS.inc(source='mined', result='accepted')
+        self.pruner.schedule(block.index)
+        self.announce_block(block)
         return block
 
-    def add_transfer(self, recipient, sender, file_name, file, signature, is_receiving=False):
-        transfer = Transfer(sender, recipient, signature, file, file_name)
+    def announce_block(self, block, source=None):
+        self.gossip.announce(
+            {'type': 'block', 'hash': hash_block(block), 'index': block.index},
+            lambda: ('/broadcast-block', Message({'block': block.to_dict()}, self.get_payload_paths(block.transfers))),
+            source, self.on_block_response)
+
+    def on_block_response(self, node, response):
+        if response.status_code == 409:
+            self.resolve_conflicts = True
+        if response.status_code in (400, 409):
+            print('Block declined by {}, needs resolving'.format(node))
+
+    def add_transfer(self, recipient, sender, file_name, file_hash, file_size, signature, source=None):
+        """Adds a transfer to the mempool and announces it to the peers,
+        except to ``source``, the peer it came from.
+
+        The payload has to be stored already. ``file_size`` is not signed,
+        so it is checked against the stored blob.
+        """
+        if not is_digest(file_hash):
+            TRANSFERS.inc(result='invalid')
+            return False
+        if signature in self.__open_transfers:
+            TRANSFERS.inc(result='duplicate')
+            return True
+        if self.storage.find_confirmed([signature]):
+            TRANSFERS.inc(result='confirmed')
+            return False
+        if self.blobs.file_size(file_hash) != file_size:
+            TRANSFERS.inc(result='wrong_size')
+            return False
+        transfer = Transfer(sender, recipient, signature, file_hash, file_name, file_size)
         if User.verify_transfer(transfer):
-            self.__open_transfers.append(transfer)
-            self.save_data()
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = f'http://{node}/broadcast-transfer'
-                    try:
-                        response = requests.post(url, json={
-                            'sender': sender,
-                            'recipient': recipient,
-                            'file_name': file_name,
-                            'file': file,
-                            'signature': signature
-                        })
-                        if response.status_code == 400 or response.status_code == 500:
-                            print('Transfer declined, needs resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
+            with self.lock.write():
+                # Checked again, another thread may have added or mined it meanwhile
+                if signature in self.__open_transfers:
+                    TRANSFERS.inc(result='duplicate')
+                    return True
+                if self.storage.find_confirmed([signature]):
+                    TRANSFERS.inc(result='confirmed')
+                    return False
+                evicted = self.__open_transfers.add(transfer)
+                if evicted is None:
+                    TRANSFERS.inc(result='too_large')
+                    return False
+                TRANSFERS.inc(result='accepted')
+                TRANSFERS.inc(len(evicted), result='evicted')
+                for tx in evicted:
+                    self.balances.remove_open_transfer(tx)
+                self.balances.add_open_transfer(transfer)
+                self.storage.add_open_transfer(transfer)
+                if evicted:
+                    self.storage.remove_open_transfers([tx.signature for tx in evicted])
+                    self.__discard_payloads(evicted)
+                self.__publish_removed(evicted)
+                self.events.publish('transfer', transfer.to_dict())
+            transfer_hash = hash_transfer(transfer)
+            self.gossip.remember_transfer(transfer_hash, signature)
+            self.gossip.announce(
+                {'type': 'transfer', 'hash': transfer_hash},
+                lambda: ('/broadcast-transfer', Message(
+                    transfer.to_dict(), self.get_payload_paths([transfer]), file_key='file')),
+                source, self.on_transfer_response)
             return True
+        TRANSFERS.inc(result='invalid')
         return False
 
-    def add_block(self, block):
-        transfers = [Transfer(
-            tx['sender'],
-            tx['recipient'],
-            tx['signature'],
-            tx['file_name'],
-            tx['file']) for tx in block['transfers']]
-
-        proof_is_valid = Verification.valid_proof(
-            transfers[:-1], block['previous_hash'], block['proof'])
-
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
-        if proof_is_valid and hashes_match:
-            converted_block = Block(
-                block['index'],
-                block['previous_hash'],
-                transfers,
-                block['proof'],
-                block['timestamp'])
-            self.__chain.append(converted_block)
-            stored_transfers = self.__open_transfers[:]
-
-            for itx in block['transfers']:
-                for opentx in stored_transfers:
-                    if (opentx.sender == itx['sender'] and
-                            opentx.recipient == itx['recipient'] and
-                            opentx.file_name == itx['file_name'] and
-                            opentx.file == itx['file'] and
-                            opentx.signature == itx['signature']):
-                        try:
-                            self.__open_transfers.remove(opentx)
-                        except ValueError:
-                            print('Item was already removed')
-            self.save_data()
-            return True
+    @staticmethod
+    def on_transfer_response(node, response):
+        if response.status_code >= 400:
+            print('Transfer declined by {}, needs resolving'.format(node))
+
+    def add_block(self, block, files=None, source=None):
+        """Appends a block received from the peer ``source`` and announces
+        it to the other peers.
+
+        The payloads the block references are stored first, ``files`` or
+        downloaded from ``source``; a block whose payloads cannot be had is
+        rejected, so it can be fetched again later.
+        """
+        try:
+            converted_block = Block.from_dict(block)
+        except (ValueError, KeyError, TypeError):
+            BLOCKS.inc(source='peer', result='rejected')
+            return False
+        if converted_block.version == 0:
+            # Only migrated history is version 0, new blocks cannot be
+            BLOCKS.inc(source='peer', result='rejected')
+            return False
+        transfers = converted_block.transfers
+
+        proof_is_valid = Verification.valid_block_proof(converted_block)
+
+        hashes_match = hash_block(self.get_last_blockchain_value()) == block['previous_hash']
+        if (proof_is_valid and hashes_match and Verification.valid_reward(transfers) and
+                Verification.has_unique_signatures(transfers) and
+                Verification.verify_transfers(transfers[:-1], self.get_balance)):
+            held = self.store_payloads(files or {})
+            try:
+                accepted = self.__append_peer_block(converted_block, source, held)
+            finally:
+                for file_hash in held:
+                    self.release_payload(file_hash)
+            if accepted:
+                BLOCKS.inc(source='peer', result='accepted')
+                self.pruner.schedule(converted_block.index)
+                self.announce_block(converted_block, source)
+            return accepted
+        BLOCKS.inc(source='peer', result='rejected')
         return False
 
-    def proof_of_work(self):
-        last_block = self.__chain[-1]
-        last_hash = hash_block(last_block)
-        proof = 0
-
-        while not Verification.valid_proof(
-            self.__open_transfers,
-            last_hash, proof
-        ):
-            proof += 1
-        return proof
+    def __append_peer_block(self, block, source, held):
+        if not self.__fetch_block_payloads(block, source, held):
+            BLOCKS.inc(source='peer', result='missing_payload')
+            return False
+        with self.lock.write():
+            tip = self.__chain[-1]
+            if hash_block(tip) != block.previous_hash or block.index != tip.index + 1:
+                BLOCKS.inc(source='peer', result='rejected')
+                return False
+            if self.storage.find_confirmed(tx.signature for tx in block.transfers):
+                print('Block {} repeats confirmed transfers'.format(block.index))
+                BLOCKS.inc(source='peer', result='rejected')
+                return False
+            self.storage.append_block(block)
+            self.__chain.append(block)
+            self.balances.add_block(block)
+            self.pow.cancel()
+            removed = self.__open_transfers.remove(tx.signature for tx in block.transfers)
+            for tx in removed:
+                self.balances.remove_open_transfer(tx)
+            self.__checkpoint()
+            self.__publish_block(block)
+            self.__publish_removed(removed)
+        return True
+
+    def __fetch_block_payloads(self, block, source, held, tip=None):
+        """Holds the payloads of ``block``, downloading the missing ones
+        from ``source``, and adds their digests to ``held``. Payloads that
+        would be pruned right away on a chain up to ``tip`` (default: the
+        block itself) are skipped."""
+        if self.pruner.is_pruned(block.index, block.index if tip is None else tip):
+            return True
+        for tx in block.transfers:
+            if self.blobs.hold(tx.file_hash):
+                held.append(tx.file_hash)
+                if self.blobs.file_size(tx.file_hash) != tx.file_size:
+                    print('Payload {} of block {} has the wrong size'.format(tx.file_hash, block.index))
+                    return False
+                continue
+            try:
+                fetched = source is not None and self.gossip.fetch_payload(source, tx.file_hash, hold=True)
+            except requests.exceptions.RequestException:
+                fetched = False
+            if fetched:
+                held.append(tx.file_hash)
+            if not fetched or self.blobs.file_size(tx.file_hash) != tx.file_size:
+                print('Payload {} of block {} is missing or has the wrong size'.format(tx.file_hash, block.index))
+                return False
+        return True
+
+    def proof_of_work(self, transfers=None):
+        """Finds a proof for a block with the given (default: all open)
+        transfers on top of the current tip.
+
+        Returns None if the search was cancelled because another block
+        extended the chain in the meantime.
+        """
+        with self.lock.read():
+            if transfers is None:
+                transfers = list(self.__open_transfers)
+            last_block = self.__chain[-1]
+        block = Block(last_block.index + 1, hash_block(last_block), transfers, None)
+        return self.pow.search(header_prefix(block.header()))
+
+    def get_headers(self, start=0, stop=None):
+        """Returns the compact headers of the blocks from height ``start``
+        up to (excluding) ``stop``."""
+        return [dict(block.header(), hash=hash_block(block)) for block in self.get_blocks(start, stop)]
+
+    def get_blocks(self, start=0, stop=None):
+        with self.lock.read():
+            return self.__chain[start:stop]
 
     def resolve(self):
-        winner_chain = self.chain
-        replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        """Syncs with the longest valid peer chain, headers first.
+
+        Every peer is asked in parallel for its headers near our tip to find
+        the fork point, then only the blocks after it are downloaded and
+        verified. The cost grows with the divergence, not the chain length.
+        Transfers of the replaced local blocks that the new branch does not
+        contain go back into the mempool. The payloads of the new blocks
+        are downloaded and held before the branch is applied; it is
+        rejected if one is missing or has the wrong size.
+        """
+        peers = self.get_peer_nodes()
+        candidates = []
+        if peers:
+            with ThreadPoolExecutor(max_workers=min(len(peers), MAX_WORKERS)) as executor:
+                candidates = [c for c in executor.map(self.fetch_branch, peers) if c is not None]
+        self.resolve_conflicts = False
+        if not candidates:
+            return False
+        node, fork_index, new_blocks = max(candidates, key=lambda c: c[1] + len(c[2]))
+
+        tip = new_blocks[-1].index
+        held = []
+        try:
+            if not all(self.__fetch_block_payloads(block, node, held, tip) for block in new_blocks):
+                BLOCKS.inc(len(new_blocks), source='sync', result='missing_payload')
+                return False
+            with self.lock.write():
+                if (fork_index + len(new_blocks) < len(self.__chain) or
+                        hash_block(self.__chain[fork_index]) != new_blocks[0].previous_hash):
+                    return False
+                replaced = [tx for block in self.__chain[fork_index + 1:] for tx in block.transfers]
+                orphaned = [tx for tx in replaced if tx.sender != 'SYSTEM']
+                for block in self.__chain[fork_index + 1:]:
+                    self.balances.remove_block(block)
+                self.storage.replace_blocks_from(fork_index + 1, new_blocks)
+                self.__chain = self.__chain[:fork_index + 1] + new_blocks
+                for block in new_blocks:
+                    self.balances.add_block(block)
+                confirmed = {tx.signature for block in new_blocks for tx in block.transfers}
+                removed = self.__open_transfers.remove(confirmed)
+                for tx in removed:
+                    self.balances.remove_open_transfer(tx)
+                self.pow.cancel()
+                self.checkpoint_height = min(self.checkpoint_height, fork_index)
+                self.__checkpoint()
+                self.events.publish('reorg', {'fork_index': fork_index})
+                for block in new_blocks:
+                    self.__publish_block(block)
+                self.__publish_removed(removed)
+                self.__restore_open_transfers([tx for tx in orphaned if tx.signature not in confirmed])
+                self.__discard_payloads(replaced)
+        finally:
+            for file_hash in held:
+                self.release_payload(file_hash)
+        BLOCKS.inc(len(new_blocks), source='sync', result='accepted')
+        self.pruner.schedule(tip)
+        return True
+
+    def __restore_open_transfers(self, transfers):
+        """Puts the transfers of orphaned blocks back into the mempool.
+        Called with the write lock held."""
+        for tx in transfers:
+            if tx.signature in self.__open_transfers or not self.blobs.has(tx.file_hash):
+                continue
+            evicted = self.__open_transfers.add(tx)
+            if evicted is None:
+                continue
+            for old in evicted:
+                self.balances.remove_open_transfer(old)
+            self.balances.add_open_transfer(tx)
+            self.storage.add_open_transfer(tx)
+            if evicted:
+                self.storage.remove_open_transfers([old.signature for old in evicted])
+                self.__discard_payloads(evicted)
+            self.__publish_removed(evicted)
+            self.events.publish('transfer', tx.to_dict())
+
+    def fetch_branch(self, node):
+        """Returns ``(node, fork_index, new_blocks)`` if ``node`` has a longer
+        valid chain, otherwise None.
+
+        The fork point is searched backwards from our tip in exponentially
+        growing steps. It has to be at or above our last version 0 block
+        and the new blocks have to be version 1 or later: version 0 blocks
+        cannot be verified anymore and are only trusted from local storage.
+        """
+        session = broadcaster.session(node)
+        with self.lock.read():
+            chain = self.__chain
+        local_length = len(chain)
+        step = 1
+        try:
+            while True:
+                start = max(0, local_length - step)
+                response = session.get('http://{}/headers'.format(node),
+                                       params={'from': start}, timeout=broadcaster.timeout)
+                headers = response.json()
+                if not headers or headers[-1]['index'] < local_length:
+                    return None
+                fork_index = None
+                for header in headers:
+                    index = header['index']
+                    if index < local_length and header['hash'] == hash_block(chain[index]):
+                        fork_index = index
+                if fork_index is not None:
+                    break
+                if start == 0:
+                    return None
+                step *= 2
+
+            legacy_height = 0
+            for block in chain:
+                if block.version != 0:
+                    break
+                legacy_height = block.index
+            if fork_index < legacy_height:
+                print('Chain of {} forks off below the legacy blocks'.format(node))
+                return None
+
+            new_headers = [header for header in headers if header['index'] > fork_index]
+            if not Verification.is_contiguous([header['index'] for header in new_headers], fork_index + 1):
+                return None
+            if not Verification.verify_headers(new_headers, hash_block(chain[fork_index])):
+                return None
+
+            response = session.get('http://{}/blocks'.format(node),
+                                   params={'from': fork_index + 1}, timeout=broadcaster.timeout)
+            new_blocks = [Block.from_dict(block) for block in response.json()]
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            return None
+        if fork_index + len(new_blocks) < local_length:
+            return None
+        if not new_blocks:
+            return None
+        if any(block.version < 1 for block in new_blocks):
+            print('Chain of {} has new version 0 blocks'.format(node))
+            return None
+        if not Verification.is_contiguous([block.index for block in new_blocks], fork_index + 1):
+            print('Chain of {} does not continue at height {}'.format(node, fork_index + 1))
+            return None
+        signed = [tx for block in new_blocks for tx in block.transfers]
+        if (not Verification.has_unique_signatures(signed) or
+                self.storage.find_confirmed((tx.signature for tx in signed), fork_index)):
+            print('Chain of {} repeats confirmed transfers'.format(node))
+            return None
+        invalid_height = Verification.find_invalid_block([chain[fork_index]] + new_blocks)
+        if invalid_height is not None:
+            print('Chain of {} is invalid at height {}'.format(node, invalid_height))
+            return None
+        return node, fork_index, new_blocks
+
+    def discard_open_transfers(self, transfers):
+        """Drops transfers whose signature no longer verifies from the mempool."""
+        with self.lock.write():
+            removed = self.__open_transfers.remove(tx.signature for tx in transfers)
+            for tx in removed:
+                print('Dropping open transfer with invalid signature: {}'.format(tx.file_name))
+                self.balances.remove_open_transfer(tx)
+            self.storage.remove_open_transfers([tx.signature for tx in transfers])
+            self.__discard_payloads(removed)
+            self.__publish_removed(removed)
+
+    def __publish_block(self, block):
+        self.events.publish('block', dict(block.header(), hash=hash_block(block),
+                                          transfer_count=len(block.transfers)))
+
+    def __publish_removed(self, transfers):
+        if transfers:
+            self.events.publish('transfers_removed', {'signatures': [tx.signature for tx in transfers]})
+
+    def get_payload_paths(self, transfers):
+        """Returns the blob store paths of the stored payloads of the given
+        transfers keyed by digest."""
+        return {tx.file_hash: self.blobs.blob_path(tx.file_hash)
+                for tx in transfers if self.blobs.has(tx.file_hash)}
+
+    def store_payloads(self, payloads):
+        """Stores raw payloads received from a peer, skipping bad digests.
+        Returns the digests of the stored payloads, which are held until
+        the caller releases them."""
+        held = []
+        for file_hash, payload in payloads.items():
+            if self.blobs.put_verified(payload, file_hash, hold=True):
+                held.append(file_hash)
+            else:
+                print('Payload does not match its digest {}'.format(file_hash))
+        return held
+
+    def release_payload(self, file_hash):
+        """Releases a held payload (see BlobStore) and deletes it if no
+        block and no open transfer refers to it, e.g. because its transfer
+        was rejected or its block was not mined."""
+        self.blobs.release(file_hash)
+        with self.lock.write():
+            self.__discard_payloads([file_hash])
+
+    def __discard_payloads(self, payloads):
+        """Deletes the payloads, given as transfers or digests, that nothing
+        refers to anymore. Called with the write lock held, so no block or
+        transfer can pick up a payload meanwhile; held payloads are kept."""
+        for file_hash in {getattr(payload, 'file_hash', payload) for payload in payloads}:
+            if not self.storage.is_referenced(file_hash):
+                self.blobs.delete(file_hash)
+
+    def fetch_payload(self, file_hash):
+        """Downloads a pruned payload into a temporary file, asking the
+        archive nodes first and then the other peers.
+
+        The content is checked against ``file_hash``. Returns the path of
+        the file, which the caller has to remove, or None.
+        """
+        peers = [node for node in self.get_peer_nodes() if node not in self.archive_nodes]
+        for node in self.archive_nodes + peers:
+            url = 'http://{}/blob/{}'.format(node, file_hash)
             try:
-                response = requests.get(url)
-                node_chain = response.json()
-                node_chain = [
-                    Block(block['index'],
-                          block['previous_hash'],
-                          [
-                              Transfer(
-                                  tx['sender'],
-                                  tx['recipient'],
-                                  tx['signature'],
-                                  tx['file_name'],
-                                  tx['file']) for tx in block['transfers']
-                          ],
-                          block['proof'],
-                          block['timestamp']) for block in node_chain
-                ]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-
-                if (node_chain_length > local_chain_length and
-                        Verification.verify_chain(node_chain)):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
+                response = broadcaster.session(node).get(url, stream=True, timeout=broadcaster.timeout)
+                if response.status_code != 200:
+                    continue
+                path = self.blobs.spool(response.iter_content(CHUNK_SIZE), file_hash)
+            except requests.exceptions.RequestException:
                 continue
-        self.resolve_conflicts = False
-        self.chain = winner_chain
-        if replace:
-            self.__open_transfers = []
-        self.save_data()
-        return replace
+            if path is not None:
+                PAYLOAD_FETCHES.inc(result='fetched')
+                return path
+            print('Payload from {} does not match its digest {}'.format(node, file_hash))
+        PAYLOAD_FETCHES.inc(result='missing')
+        return None
 
     def add_peer_node(self, node):
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.lock.write():
+            self.__peer_nodes.add(node)
+            self.storage.add_peer_node(node)
+            self.events.publish('peers', {'nodes': list(self.__peer_nodes)})
 
     def remove_peer_node(self, node):
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.lock.write():
+            self.__peer_nodes.discard(node)
+            self.storage.remove_peer_node(node)
+            self.events.publish('peers', {'nodes': list(self.__peer_nodes)})
+        broadcaster.forget(node)
 
     def get_peer_nodes(self):
-        peer_nodes_list = list(self.__peer_nodes)
+        with self.lock.read():
+            peer_nodes_list = list(self.__peer_nodes)
         return peer_nodes_list
@@ -0,0 +1,185 @@
+"""Delivers transfers and blocks to peer nodes in the background."""
+
+import queue
+import threading
+import time
+from collections import deque, OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import wire
+from metrics import Counter, Histogram
+
+MAX_WORKERS = 8
+TIMEOUT = (3.05, 10)
+RETRIES = 2
+BACKOFF = 0.5
+QUEUE_SIZE = 1000
+MAX_SESSIONS = 64
+
+DELIVERY_SECONDS = Histogram('broadcast_latency_seconds', 'Latency of deliveries to peers.', ['peer'])
+DELIVERIES = Counter('broadcast_deliveries_total', 'Delivery attempts to peers by outcome.',
+                     ['peer', 'result'])
+
+
+class Broadcaster:
+    """Fans messages out to peers without blocking the caller.
+
+    Every peer gets its own queue of at most ``queue_size`` messages. A
+    pool of ``max_workers`` threads serves the queues, taking at most one
+    message of a peer at a time, so a block never overtakes the block
+    before it and a slow or unreachable peer only holds up its own
+    messages and a single worker. When a peer's queue is full new messages
+    to it are dropped. Failed deliveries are retried with exponential
+    backoff and the outcome per peer is kept for ``/nodes/status``.
+
+    Keep-alive ``requests.Session`` objects are kept for the
+    ``max_sessions`` nodes used last, nodes that are only fetched from
+    now and then are closed when they fall out.
+
+    ``wire.Message`` payloads go out in the binary wire format, or as JSON
+    to peers that turned it down once.
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF, queue_size=QUEUE_SIZE,
+                 max_workers=MAX_WORKERS, max_sessions=MAX_SESSIONS):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self.max_workers = max_workers
+        self.max_sessions = max_sessions
+        self.__queues = {}
+        # Peers that have a message waiting in __ready or being delivered
+        self.__busy = set()
+        self.__ready = queue.Queue()
+        self.__workers = []
+        self.__sessions = OrderedDict()
+        self.__status = {}
+        self.__json_peers = set()
+        self.__lock = threading.Lock()
+
+    def session(self, peer):
+        """Returns the pooled session used for all requests to ``peer``."""
+        with self.__lock:
+            session = self.__sessions.pop(peer, None)
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+            self.__sessions[peer] = session
+            evicted = []
+            while len(self.__sessions) > self.max_sessions:
+                evicted.append(self.__sessions.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return session
+
+    def forget(self, peer):
+        with self.__lock:
+            session = self.__sessions.pop(peer, None)
+            self.__queues.pop(peer, None)
+            self.__status.pop(peer, None)
+            self.__json_peers.discard(peer)
+        if session is not None:
+            session.close()
+
+    def broadcast(self, peers, path, payload, on_response=None):
+        """Queues ``payload`` (a dict or a ``wire.Message``) to be POSTed
+        to ``path`` on every peer.
+
+        ``on_response(peer, response)`` is called from a worker thread for
+        every peer that answered.
+        """
+        for peer in peers:
+            with self.__lock:
+                pending = self.__queues.setdefault(peer, deque())
+                dropped = len(pending) >= self.queue_size
+                if not dropped:
+                    pending.append((path, payload, on_response))
+                    if peer not in self.__busy:
+                        self.__busy.add(peer)
+                        self.__ready.put(peer)
+                self.__start_workers()
+            if dropped:
+                DELIVERIES.inc(peer=peer, result='dropped')
+
+    def get_status(self):
+        with self.__lock:
+            return {peer: dict(status) for peer, status in self.__status.items()}
+
+    def __start_workers(self):
+        while len(self.__workers) < self.max_workers:
+            worker = threading.Thread(target=self.__dispatch, daemon=True,
+                                      name='broadcast-{}'.format(len(self.__workers)))
+            worker.start()
+            self.__workers.append(worker)
+
+    def __dispatch(self):
+        while True:
+            peer = self.__ready.get()
+            with self.__lock:
+                pending = self.__queues.get(peer)
+                if not pending:
+                    self.__busy.discard(peer)
+                    continue
+                path, payload, on_response = pending.popleft()
+            try:
+                self.__deliver(peer, path, payload, on_response)
+            except Exception as e:
+                print('Delivering to {} failed: {}'.format(peer, e))
+            with self.__lock:
+                # Back to the end of the line, so the other peers get their turn
+                if self.__queues.get(peer):
+                    self.__ready.put(peer)
+                else:
+                    self.__busy.discard(peer)
+
+    def __deliver(self, peer, path, payload, on_response):
+        url = 'http://{}{}'.format(peer, path)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.__post(peer, url, payload)
+            except requests.exceptions.RequestException as e:
+                self.__record(peer, None, str(e), time.perf_counter() - start)
+            else:
+                self.__record(peer, response.status_code, None, time.perf_counter() - start)
+                if response.status_code < 500:
+                    if on_response is not None:
+                        on_response(peer, response)
+                    return
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def __post(self, peer, url, payload):
+        session = self.session(peer)
+        if not isinstance(payload, wire.Message):
+            return session.post(url, json=payload, timeout=self.timeout)
+        if peer not in self.__json_peers:
+            response = session.post(url, data=payload.encode(), timeout=self.timeout,
+                                    headers={'Content-Type': wire.CONTENT_TYPE})
+            if response.status_code != 415:
+                return response
+            with self.__lock:
+                self.__json_peers.add(peer)
+        return session.post(url, data=payload.to_json(), timeout=self.timeout,
+                            headers={'Content-Type': 'application/json'})
+
+    def __record(self, peer, status_code, error, latency):
+        delivered = error is None and status_code < 500
+        DELIVERY_SECONDS.observe(latency, peer=peer)
+        DELIVERIES.inc(peer=peer, result='delivered' if delivered else 'failed')
+        with self.__lock:
+            status = self.__status.setdefault(peer, {'delivered': 0, 'failed': 0})
+            status['last_status'] = status_code
+            status['last_error'] = error
+            status['latency'] = round(latency, 4)
+            status['last_attempt'] = time.time()
+            if delivered:
+                status['delivered'] += 1
+            else:
+                status['failed'] += 1
+
+
+broadcaster = Broadcaster()
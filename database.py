@@ -0,0 +1,112 @@
+"""Shared, long-lived SQLite connections per database file."""
+
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+READER_POOL_SIZE = 4
+BUSY_TIMEOUT = 5000
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA busy_timeout = {}'.format(BUSY_TIMEOUT),
+)
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class Database:
+    """One writer and a small pool of readers on a single SQLite file.
+
+    The file runs in WAL mode, so readers keep working on their snapshot
+    while a write transaction is open. Writes are serialized on the single
+    writer connection, each one in an explicit transaction. All connections
+    stay open for the life of the process and keep their prepared
+    statements cached.
+    """
+
+    def __init__(self, path, pool_size=READER_POOL_SIZE):
+        self.path = path
+        self.__write_lock = threading.RLock()
+        self.__writer = self.__open()
+        self.__readers = queue.Queue(maxsize=pool_size)
+
+    @classmethod
+    def open(cls, path):
+        """Returns the shared Database for ``path``."""
+        with _databases_lock:
+            if path not in _databases:
+                _databases[path] = cls(path)
+            return _databases[path]
+
+    def __open(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def write(self):
+        """Yields the writer connection inside a transaction that is
+        committed on success and rolled back on error."""
+        with self.__write_lock:
+            conn = self.__writer
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    @contextmanager
+    def read(self):
+        """Yields a reader connection from the pool."""
+        try:
+            conn = self.__readers.get_nowait()
+        except queue.Empty:
+            conn = self.__open()
+        try:
+            yield conn
+        finally:
+            try:
+                self.__readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def execute_outside_transaction(self, sql):
+        """Runs a statement like VACUUM that cannot run in a transaction."""
+        with self.__write_lock:
+            self.__writer.execute(sql)
+
+    def size_bytes(self):
+        """Returns the size of the database file and its WAL on disk."""
+        paths = (self.path, self.path + '-wal', self.path + '-shm')
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def close(self):
+        with self.__write_lock:
+            self.__writer.close()
+        while True:
+            try:
+                self.__readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+@atexit.register
+def close_all():
+    with _databases_lock:
+        for database in _databases.values():
+            database.close()
+        _databases.clear()
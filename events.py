@@ -0,0 +1,65 @@
+"""Pushes changes of the chain, the mempool and the peers to the web UI.
+
+Every change is published as a small event with an increasing id:
+
+    block               the header and hash of a block appended to the tip
+    reorg               ``fork_index``: the blocks after it were replaced,
+                        ``block`` events for the new branch follow
+    transfer            an open transfer added to the mempool
+    transfers_removed   ``signatures`` of open transfers that were mined,
+                        evicted or dropped
+    peers               ``nodes``: the peer nodes after a change
+    reset               the client missed events and has to reload
+
+The last ``EVENT_HISTORY`` events are kept, so a client that reconnects
+with the id of the last event it got receives what it missed.
+"""
+
+import threading
+import time
+from collections import deque
+
+import metrics
+
+EVENT_HISTORY = 1024
+
+EVENTS = metrics.Counter('events_published_total', 'Events pushed to the web UI by type.', ['type'])
+
+
+class EventBus:
+    def __init__(self, history=EVENT_HISTORY):
+        self.__events = deque(maxlen=history)
+        self.__condition = threading.Condition()
+        # Ids continue from the clock, so a client still holding an id of
+        # an earlier run of the node is told to reset rather than skipping
+        # the events of this one.
+        self.__last_id = int(time.time() * 1000)
+
+    @property
+    def last_id(self):
+        with self.__condition:
+            return self.__last_id
+
+    def publish(self, kind, data):
+        with self.__condition:
+            self.__last_id += 1
+            self.__events.append({'id': self.__last_id, 'type': kind, 'data': data})
+            self.__condition.notify_all()
+        EVENTS.inc(type=kind)
+
+    def wait(self, after, timeout):
+        """Returns the events after the id ``after``, waiting up to
+        ``timeout`` seconds for one if there are none yet."""
+        with self.__condition:
+            if after is None or after > self.__last_id:
+                return [self.__reset()]
+            self.__condition.wait_for(lambda: self.__last_id > after, timeout)
+            if after == self.__last_id:
+                return []
+            first_id = self.__events[0]['id']
+            if after < first_id - 1:
+                return [self.__reset()]
+            return list(self.__events)[after - first_id + 1:]
+
+    def __reset(self):
+        return {'id': self.__last_id, 'type': 'reset', 'data': {}}
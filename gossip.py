@@ -0,0 +1,250 @@
+"""Announces transfers and blocks to peers by hash and fetches what is new.
+
+Instead of pushing every transfer and block with its files to every peer,
+a node POSTs a small inventory to ``/inventory``::
+
+    {"port": 5000, "items": [{"type": "block", "hash": "...", "index": 7},
+                             {"type": "transfer", "hash": "..."}]}
+
+The receiver fetches the items it has not seen from the announcing node
+(``/block/hash/<hash>``, ``/transfer/hash/<hash>`` and ``/blob/<hash>``
+for payloads it does not have) and announces them to its own peers once
+accepted. A bounded cache of seen hashes stops the announcements from
+going around in circles, so each node fetches every item and payload
+once no matter how many peers announce it.
+"""
+
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import requests
+
+from blob_store import CHUNK_SIZE
+from broadcaster import broadcaster
+from metrics import Counter
+from transfer import Transfer
+from users import User
+from utility.hash_util import hash_transfer
+
+SEEN_CACHE_SIZE = 65536
+FETCH_WORKERS = 4
+MAX_INVENTORY_ITEMS = 500
+MAX_PENDING_FETCHES = 2048
+
+ITEMS = Counter('gossip_items_total', 'Inventory items by type and outcome.', ['type', 'result'])
+
+
+@lru_cache(maxsize=256)
+def host_addresses(host):
+    """Returns the IP addresses ``host`` resolves to."""
+    try:
+        return frozenset(info[4][0] for info in socket.getaddrinfo(host, None))
+    except socket.gaierror:
+        return frozenset()
+
+
+class SeenCache:
+    """The most recently seen item hashes, oldest forgotten first."""
+
+    def __init__(self, size=SEEN_CACHE_SIZE):
+        self.size = size
+        self.__hashes = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add(self, item_hash, value=True):
+        """Remembers ``item_hash`` and returns False if it was seen before."""
+        with self.__lock:
+            if item_hash in self.__hashes:
+                self.__hashes.move_to_end(item_hash)
+                return False
+            self.__hashes[item_hash] = value
+            if len(self.__hashes) > self.size:
+                self.__hashes.popitem(last=False)
+            return True
+
+    def get(self, item_hash):
+        with self.__lock:
+            return self.__hashes.get(item_hash)
+
+    def discard(self, item_hash):
+        with self.__lock:
+            self.__hashes.pop(item_hash, None)
+
+
+class Gossip:
+    """The announce and fetch side of a node's peer protocol.
+
+    Blocks are fetched one after another on a single thread so they are
+    appended in order; transfers are fetched on a small pool. At most
+    ``max_pending`` fetches wait at a time, further items are dropped and
+    can be announced again.
+    """
+
+    def __init__(self, blockchain, fetch_workers=FETCH_WORKERS, max_pending=MAX_PENDING_FETCHES):
+        self.blockchain = blockchain
+        self.seen = SeenCache()
+        self.transfers = SeenCache()
+        self.max_pending = max_pending
+        self.__pending = 0
+        self.__pending_lock = threading.Lock()
+        self.__block_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gossip-blocks')
+        self.__transfer_executor = ThreadPoolExecutor(max_workers=fetch_workers,
+                                                      thread_name_prefix='gossip-transfers')
+
+    def announce(self, item, legacy_message, source=None, on_response=None):
+        """Announces ``item`` to every peer except ``source``.
+
+        Peers that do not know ``/inventory`` yet get ``legacy_message()``,
+        a ``(path, wire.Message)`` pair, pushed to them instead.
+        """
+        self.seen.add(item['hash'])
+        peers = [node for node in self.blockchain.get_peer_nodes() if node != source]
+        if not peers:
+            return
+        ITEMS.inc(len(peers), type=item['type'], result='announced')
+
+        def on_announce_response(node, response):
+            if response.status_code == 404:
+                path, message = legacy_message()
+                broadcaster.broadcast([node], path, message, on_response)
+            elif on_response is not None:
+                on_response(node, response)
+
+        broadcaster.broadcast(peers, '/inventory', {
+            'port': self.blockchain.node_id,
+            'items': [item]
+        }, on_announce_response)
+
+    def find_peer(self, address, port):
+        """Returns the name ``address:port`` is registered under as a peer
+        (e.g. ``localhost:5001`` for ``127.0.0.1:5001``), or ``address:port``
+        if it is not a peer."""
+        for node in self.blockchain.get_peer_nodes():
+            host, _, node_port = node.rpartition(':')
+            if node_port == str(port) and (host == address or address in host_addresses(host)):
+                return node
+        return '{}:{}'.format(address, port)
+
+    def remember_transfer(self, transfer_hash, signature):
+        """Makes an open transfer available at ``/transfer/hash/<hash>``."""
+        self.transfers.add(transfer_hash, signature)
+
+    def find_transfer(self, transfer_hash):
+        """Returns the signature of an announced transfer or None."""
+        return self.transfers.get(transfer_hash)
+
+    def receive(self, node, items):
+        """Queues fetching the announced items that are new.
+
+        ``items`` are dicts with a string ``type`` and ``hash``, items of
+        an unknown type are skipped. Returns the number of items requested
+        and whether an announced block is not ahead of the local chain,
+        i.e. ``node`` is behind or on another branch.
+        """
+        requested = 0
+        behind = False
+        tip = self.blockchain.get_last_blockchain_value().index
+        for item in items:
+            kind, item_hash = item['type'], item['hash']
+            if kind not in ('block', 'transfer'):
+                continue
+            if not self.seen.add(item_hash):
+                ITEMS.inc(type=kind, result='duplicate')
+                continue
+            if not self.__reserve():
+                self.seen.discard(item_hash)
+                ITEMS.inc(type=kind, result='dropped')
+                continue
+            if kind == 'block':
+                index = item.get('index')
+                if not isinstance(index, int):
+                    self.__release()
+                    self.seen.discard(item_hash)
+                    continue
+                if index <= tip:
+                    self.__release()
+                    known = self.blockchain.get_blocks(index, index + 1)
+                    if not known or known[0].hash != item_hash:
+                        self.seen.discard(item_hash)
+                        behind = True
+                    continue
+                if index > tip + 1:
+                    self.__release()
+                    self.seen.discard(item_hash)
+                    self.blockchain.resolve_conflicts = True
+                    continue
+                self.__block_executor.submit(self.__fetch, self.__fetch_block, node, item_hash, kind)
+            else:
+                self.__transfer_executor.submit(self.__fetch, self.__fetch_transfer, node, item_hash, kind)
+            requested += 1
+        return requested, behind
+
+    def __reserve(self):
+        with self.__pending_lock:
+            if self.__pending >= self.max_pending:
+                return False
+            self.__pending += 1
+            return True
+
+    def __release(self):
+        with self.__pending_lock:
+            self.__pending -= 1
+
+    def __fetch(self, fetch, node, item_hash, kind):
+        try:
+            accepted = fetch(node, item_hash)
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            print('Fetching {} {} from {} failed: {}'.format(kind, item_hash, node, e))
+            accepted = False
+        finally:
+            self.__release()
+        if not accepted:
+            self.seen.discard(item_hash)
+        ITEMS.inc(type=kind, result='fetched' if accepted else 'failed')
+
+    def __fetch_block(self, node, block_hash):
+        response = broadcaster.session(node).get('http://{}/block/hash/{}'.format(node, block_hash),
+                                                 timeout=broadcaster.timeout)
+        if response.status_code != 200:
+            return False
+        block = response.json()
+        if block.pop('hash', None) != block_hash:
+            return False
+        if block['index'] != self.blockchain.get_last_blockchain_value().index + 1:
+            self.blockchain.resolve_conflicts = True
+            return False
+        return self.blockchain.add_block(block, source=node)
+
+    def __fetch_transfer(self, node, transfer_hash):
+        session = broadcaster.session(node)
+        response = session.get('http://{}/transfer/hash/{}'.format(node, transfer_hash),
+                               timeout=broadcaster.timeout)
+        if response.status_code != 200:
+            return False
+        tx = response.json()
+        transfer = Transfer.from_dict(tx)
+        if hash_transfer(transfer) != transfer_hash or not User.verify_transfer(transfer):
+            return False
+        if not self.fetch_payload(node, tx['file_hash'], hold=True):
+            return False
+        try:
+            return self.blockchain.add_transfer(tx['recipient'], tx['sender'], tx['file_name'], tx['file_hash'],
+                                                tx['file_size'], tx['signature'], source=node)
+        finally:
+            self.blockchain.release_payload(tx['file_hash'])
+
+    def fetch_payload(self, node, file_hash, hold=False):
+        """Makes sure the payload ``file_hash`` is stored, downloading it
+        from ``node`` if it is not. With ``hold`` the blob is held (see
+        BlobStore) if this returns True."""
+        blobs = self.blockchain.blobs
+        if blobs.hold(file_hash) if hold else blobs.has(file_hash):
+            return True
+        response = broadcaster.session(node).get('http://{}/blob/{}'.format(node, file_hash),
+                                                 stream=True, timeout=broadcaster.timeout)
+        if response.status_code != 200:
+            return False
+        return blobs.put_chunks(response.iter_content(CHUNK_SIZE), file_hash, hold) is not None
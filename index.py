@@ -1,16 +1,79 @@
 import base64
-import json
-import sqlite3
-
-from flask import Flask, jsonify, request, send_from_directory, make_response
+import cProfile
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Flask, g, jsonify, request, send_file, send_from_directory
 from flask_cors import CORS
 
+import metrics
+import wire
 from blockchain import Blockchain
+from broadcaster import broadcaster
+from gossip import MAX_INVENTORY_ITEMS
+from mempool import MAX_BYTES, MAX_TRANSFERS
+from mining_jobs import MiningJobs
+from transfer import Transfer
 from users import User
 
 app = Flask(__name__)
 CORS(app)
 
+RESPONSE_CACHE_SIZE = 64
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+profile_dir = None
+mining_jobs = MiningJobs()
+MAX_JOB_WAIT = 30
+MAX_PEER_MESSAGE_SIZE = 64 * 1024 * 1024
+MAX_EVENT_WAIT = 30
+EVENT_KEEPALIVE = 15
+
+REQUEST_SECONDS = metrics.Histogram('http_request_duration_seconds', 'Latency of HTTP requests.',
+                                    ['endpoint', 'method', 'status'])
+metrics.Gauge('blockchain_height', 'Index of the last block.').set_function(
+    lambda: blockchain.get_last_blockchain_value().index)
+metrics.Gauge('blockchain_checkpoint_height', 'Index of the last checkpointed block.').set_function(
+    lambda: blockchain.checkpoint_height)
+metrics.Gauge('blockchain_pruned_height', 'Index of the last block whose payloads were pruned.').set_function(
+    lambda: blockchain.pruner.height)
+metrics.Gauge('blob_store_bytes', 'Size of the stored file payloads.').set_function(
+    lambda: blockchain.blobs.size_bytes())
+metrics.Gauge('mempool_transfers', 'Number of open transfers.').set_function(
+    lambda: blockchain.get_mempool_size()[0])
+metrics.Gauge('mempool_bytes', 'Size of the files of the open transfers.').set_function(
+    lambda: blockchain.get_mempool_size()[1])
+metrics.Gauge('database_bytes', 'Size of the node database on disk.').set_function(
+    lambda: blockchain.storage.db.size_bytes())
+
+
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    if profile_dir is not None and request.args.get('profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_request(response):
+    """Records the request latency and, for ``?profile=1`` requests when
+    profiling is switched on, dumps a cProfile of the request."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        endpoint = request.endpoint or 'unknown'
+        path = os.path.join(profile_dir, '{}-{}.prof'.format(endpoint, time.strftime('%Y%m%d-%H%M%S')))
+        profiler.dump_stats(path)
+        response.headers['X-Profile'] = path
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                            endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
 
 @app.route('/', methods=['GET'])
 def index():
@@ -35,8 +98,7 @@ def get_network_ui_pl():
 @app.route('/user', methods=['POST'])
 def create_keys():
     if user.create_keys():
-        global blockchain
-        blockchain = Blockchain(user.public_key, port)
+        blockchain.public_key = user.public_key
         response = {
             'public_key': user.public_key,
             'private_key': user.private_key,
@@ -52,8 +114,7 @@ def create_keys():
 @app.route('/user', methods=['GET'])
 def load_keys():
     if user.load_keys_from_database():
-        global blockchain
-        blockchain = Blockchain(user.public_key, port)
+        blockchain.public_key = user.public_key
         response = {
             'public_key': user.public_key,
             'private_key': user.private_key,
@@ -66,23 +127,76 @@ def load_keys():
         return jsonify(response), 500
 
 
+class MessageTooLarge(ValueError):
+    pass
+
+
+def read_peer_message():
+    """Returns the values and raw files of a message from a peer, sent
+    either in the binary wire format or as JSON with base64 payloads.
+
+    The body is only read if its ``Content-Length`` is at most
+    ``MAX_PEER_MESSAGE_SIZE``, otherwise MessageTooLarge is raised; peers
+    fetch larger payloads from ``/blob`` instead. Raises ValueError if the
+    message cannot be decoded.
+    """
+    if request.content_length is None or request.content_length > MAX_PEER_MESSAGE_SIZE:
+        raise MessageTooLarge('Message is too large')
+    if request.mimetype == wire.CONTENT_TYPE:
+        return wire.decode(request.get_data(cache=False))
+    values = request.get_json()
+    if not values:
+        return values, {}
+    if not isinstance(values, dict) or not isinstance(values.get('files') or {}, dict):
+        raise ValueError('Message is not an object')
+    try:
+        files = {file_hash: base64.b64decode(payload)
+                 for file_hash, payload in (values.get('files') or {}).items()}
+        if values.get('file') is not None and 'file_hash' in values:
+            files[values['file_hash']] = base64.b64decode(values['file'])
+    except TypeError as e:
+        raise ValueError(e)
+    return values, files
+
+
 @app.route('/broadcast-transfer', methods=['POST'])
 def broadcast_transfer():
-    values = request.get_json()
+    try:
+        values, files = read_peer_message()
+    except MessageTooLarge:
+        response = {'message': 'Message is too large.'}
+        return jsonify(response), 413
+    except ValueError:
+        response = {'message': 'Malformed message.'}
+        return jsonify(response), 400
     if not values:
         response = {'message': 'No data found.'}
         return jsonify(response), 400
-    required = ['sender', 'recipient', 'file_name', 'file', 'signature']
-    if not all(key in values for key in required):
+    required = ['sender', 'recipient', 'file_name', 'file_hash', 'file_size', 'signature']
+    if not all(key in values for key in required) or values['file_hash'] not in files:
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
-    success = blockchain.add_transfer(
-        values['recipient'],
-        values['sender'],
-        values['file_name'],
-        values['file'],
-        values['signature'],
-        is_receiving=True)
+    try:
+        transfer = Transfer.from_dict(values)
+    except ValueError:
+        response = {'message': 'Malformed transfer.'}
+        return jsonify(response), 400
+    if not User.verify_transfer(transfer):
+        response = {'message': 'Invalid signature.'}
+        return jsonify(response), 400
+    if not blockchain.blobs.put_verified(files[values['file_hash']], values['file_hash'], hold=True):
+        response = {'message': 'File does not match its hash.'}
+        return jsonify(response), 400
+    try:
+        success = blockchain.add_transfer(
+            values['recipient'],
+            values['sender'],
+            values['file_name'],
+            values['file_hash'],
+            values['file_size'],
+            values['signature'])
+    finally:
+        blockchain.release_payload(values['file_hash'])
     if success:
         response = {
             'message': 'Successfully added transfer.',
@@ -90,7 +204,8 @@ def broadcast_transfer():
                 'sender': values['sender'],
                 'recipient': values['recipient'],
                 'file_name': values['file_name'],
-                'file': values['file'],
+                'file_hash': values['file_hash'],
+                'file_size': values['file_size'],
                 'signature': values['signature']
             }
         }
@@ -104,7 +219,14 @@ def broadcast_transfer():
 
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    try:
+        values, files = read_peer_message()
+    except MessageTooLarge:
+        response = {'message': 'Message is too large.'}
+        return jsonify(response), 413
+    except ValueError:
+        response = {'message': 'Malformed message.'}
+        return jsonify(response), 400
     if not values:
         response = {'message': 'No data found.'}
         return jsonify(response), 400
@@ -112,14 +234,19 @@ def broadcast_block():
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
     block = values['block']
-    if block['index'] == blockchain.chain[-1].index + 1:
-        if blockchain.add_block(block):
+    if (not isinstance(block, dict) or not isinstance(block.get('index'), int) or
+            isinstance(block['index'], bool)):
+        response = {'message': 'Malformed block.'}
+        return jsonify(response), 400
+    last_index = blockchain.get_last_blockchain_value().index
+    if block['index'] == last_index + 1:
+        if blockchain.add_block(block, files):
             response = {'message': 'Block added'}
             return jsonify(response), 201
         else:
             response = {'message': 'Block seems invalid.'}
             return jsonify(response), 409
-    elif block['index'] > blockchain.chain[-1].index:
+    elif block['index'] > last_index:
         response = {
             'message': 'Blockchain seems to differ from local blockchain.'}
         blockchain.resolve_conflicts = True
@@ -130,6 +257,56 @@ def broadcast_block():
         return jsonify(response), 409
 
 
+@app.route('/inventory', methods=['POST'])
+def receive_inventory():
+    """Takes the hashes of transfers and blocks a peer announces and
+    fetches the new ones from it in the background."""
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or 'port' not in values or not isinstance(values.get('items'), list):
+        response = {'message': 'Some data is missing.'}
+        return jsonify(response), 400
+    port = read_port(values['port'])
+    if port is None:
+        response = {'message': 'Invalid port.'}
+        return jsonify(response), 400
+    if len(values['items']) > MAX_INVENTORY_ITEMS:
+        response = {'message': 'Too many items.'}
+        return jsonify(response), 413
+    if not all(isinstance(item, dict) and isinstance(item.get('type'), str) and isinstance(item.get('hash'), str)
+               for item in values['items']):
+        response = {'message': 'Malformed items.'}
+        return jsonify(response), 400
+    node = blockchain.gossip.find_peer(request.remote_addr, port)
+    requested, behind = blockchain.gossip.receive(node, values['items'])
+    if behind:
+        response = {'message': 'Blockchain seems to be shorter, block not added'}
+        return jsonify(response), 409
+    response = {'message': 'Inventory received.', 'requested': requested}
+    return jsonify(response), 202
+
+
+def read_port(value):
+    """Returns ``value`` as a TCP port number, or None if it is not one.
+    The port is put into the URL fetched from, so nothing else is let
+    through."""
+    if isinstance(value, bool):
+        return None
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        return None
+    return port if 1 <= port <= 65535 else None
+
+
+@app.route('/transfer/hash/<transfer_hash>', methods=['GET'])
+def get_transfer_by_hash(transfer_hash):
+    signature = blockchain.gossip.find_transfer(transfer_hash)
+    transfer = blockchain.get_open_transfer(signature) if signature is not None else None
+    if transfer is None:
+        return jsonify({'message': 'Transfer not found'}), 404
+    return jsonify(transfer.to_dict()), 200
+
+
 @app.route('/transfer', methods=['POST'])
 def add_transfer():
     if user.public_key is None:
@@ -142,12 +319,13 @@ def add_transfer():
 
     if recipient and uploaded_file:
         file_name = uploaded_file.filename
-        binary_data = uploaded_file.read()
-        base64_data = base64.b64encode(binary_data).decode('utf-8')
-        signature = user.sign_transfer(user.public_key, recipient, base64_data)
-
-        success = blockchain.add_transfer(
-            recipient, user.public_key, file_name, base64_data, signature)
+        file_hash, file_size = blockchain.blobs.put_stream(uploaded_file.stream, hold=True)
+        try:
+            signature = user.sign_transfer(user.public_key, recipient, file_name, file_hash)
+            success = blockchain.add_transfer(
+                recipient, user.public_key, file_name, file_hash, file_size, signature)
+        finally:
+            blockchain.release_payload(file_hash)
         if success:
             response = {
                 'message': 'Successfully added transfer.',
@@ -155,7 +333,8 @@ def add_transfer():
                     'sender': user.public_key,
                     'recipient': recipient,
                     'file_name': file_name,
-                    'file': base64_data,
+                    'file_hash': file_hash,
+                    'file_size': file_size,
                     'signature': signature
                 },
             }
@@ -169,39 +348,53 @@ def add_transfer():
 
 @app.route('/mine', methods=['POST'])
 def mine():
+    """Stores the uploaded reward file and queues mining a block with it.
+
+    Answers 202 with the id of the job; ``GET /mine/<job_id>`` reports
+    when the block has been added.
+    """
     file = request.files['file']
 
     if file:
-        file_name = file.filename
-        binary_data = file.read()
-        base64_data = base64.b64encode(binary_data).decode('utf-8')
-        block = blockchain.mine_block(base64_data, file_name)
-        if block is not None:
-            dict_block = block.__dict__.copy()
-            dict_block['transfers'] = [
-                tx.__dict__ for tx in dict_block['transfers']]
-            response = {
-                'message': 'Block added successfully.',
-                'block': {
-                    'index': dict_block['index'],
-                    'previous_hash': dict_block['previous_hash'],
-                    'transfers': dict_block['transfers'],
-                    'proof': dict_block['proof'],
-                    'timestamp': dict_block['timestamp'],
-                },
-            }
-            return jsonify(response), 201
-        else:
+        if user.public_key is None:
             response = {
                 'message': 'Adding a block failed.',
-                'user_set_up': user.public_key is not None
+                'user_set_up': False
             }
             return jsonify(response), 500
+        file_name = file.filename
+        file_hash, file_size = blockchain.blobs.put_stream(file.stream, hold=True)
+        job = mining_jobs.submit(mine_held_block, file_hash, file_name, file_size)
+        response = {
+            'message': 'Mining started.',
+            'job_id': job.job_id,
+            'status_url': '/mine/{}'.format(job.job_id)
+        }
+        return jsonify(response), 202
     else:
         response = {'message': 'No file uploaded.'}
         return jsonify(response), 400
 
 
+def mine_held_block(file_hash, file_name, file_size):
+    """Mines a block with the held reward file and releases it."""
+    try:
+        return blockchain.mine_block(file_hash, file_name, file_size)
+    finally:
+        blockchain.release_payload(file_hash)
+
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    """Returns the status of a mining job. With ``?wait=<seconds>`` the
+    request is held until the job finishes or the time runs out."""
+    wait = min(request.args.get('wait', 0, type=float), MAX_JOB_WAIT)
+    job = mining_jobs.get(job_id, wait)
+    if job is None:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
     replaced = blockchain.resolve()
@@ -214,19 +407,116 @@ def resolve_conflicts():
 
 @app.route('/transfers', methods=['GET'])
 def get_open_transfer():
-    transfers = blockchain.get_open_transfers()
-    dict_transfers = [tx.__dict__ for tx in transfers]
-    return jsonify(dict_transfers), 200
+    """Returns the open transfers, paginated with ``from`` and ``limit``.
+
+    There is no ``since``: positions in the mempool shift as transfers are
+    mined or evicted, so one could not tell what a client has already seen.
+    """
+    if 'since' in request.args:
+        response = {'message': 'since is not supported for open transfers.'}
+        return jsonify(response), 400
+    start, stop = page_args()
+    transfers = blockchain.get_open_transfers(start, stop)
+    digest = hashlib.sha256(''.join(tx.signature for tx in transfers).encode()).hexdigest()
+    return cached_json(('transfers', digest, start, stop),
+                       lambda: [tx.to_dict() for tx in transfers])
 
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    for dict_block in dict_chain:
-        dict_block['transfers'] = [
-            tx.__dict__ for tx in dict_block['transfers']]
-    return jsonify(dict_chain), 200
+    """Returns the blocks of the chain.
+
+    ``from`` and ``limit`` select a page of blocks by height, ``since``
+    returns only the blocks after the given height and ``headers_only``
+    leaves the transfers out.
+    """
+    start, stop = page_args()
+    if is_flag_set('headers_only'):
+        return get_headers_page(start, stop)
+    return get_blocks_page(start, stop)
+
+
+@app.route('/headers', methods=['GET'])
+def get_headers():
+    return get_headers_page(*page_args())
+
+
+@app.route('/blocks', methods=['GET'])
+def get_blocks():
+    return get_blocks_page(*page_args())
+
+
+def get_headers_page(start, stop):
+    tip, stop = chain_tip(stop)
+    return cached_json(('headers', tip.hash, start, stop),
+                       lambda: blockchain.get_headers(start, stop),
+                       chain_headers(tip))
+
+
+def get_blocks_page(start, stop):
+    tip, stop = chain_tip(stop)
+    return cached_json(('blocks', tip.hash, start, stop),
+                       lambda: [block.to_dict() for block in blockchain.get_blocks(start, stop)],
+                       chain_headers(tip))
+
+
+def chain_tip(stop):
+    """Returns the current tip and ``stop`` capped to it, so a page never
+    holds blocks appended after the tip was read."""
+    tip = blockchain.get_last_blockchain_value()
+    if stop is None or stop > tip.index + 1:
+        stop = tip.index + 1
+    return tip, stop
+
+
+def chain_headers(tip):
+    return {'X-Chain-Height': str(tip.index), 'X-Chain-Tip': tip.hash}
+
+
+def page_args():
+    """Reads the ``from``/``since`` and ``limit`` query arguments as a
+    ``(start, stop)`` slice."""
+    since = request.args.get('since', type=int)
+    if since is not None:
+        start = since + 1
+    else:
+        start = request.args.get('from', 0, type=int)
+    start = max(start, 0)
+    limit = request.args.get('limit', type=int)
+    stop = None if limit is None else start + max(limit, 0)
+    return start, stop
+
+
+def is_flag_set(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def cached_json(key, build, headers=None):
+    """Returns the JSON response for ``key``, serializing ``build()`` only
+    on a cache miss.
+
+    Keys hold the chain tip hash (or a digest of the open transfers), so an
+    entry never goes stale, it is just not asked for anymore. The key also
+    gives the ETag, so a poll of unchanged data is answered with 304.
+    """
+    etag = hashlib.sha256(repr(key).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+    with response_cache_lock:
+        body = response_cache.get(key)
+        if body is not None:
+            response_cache.move_to_end(key)
+    if body is None:
+        body = app.json.dumps(build())
+        with response_cache_lock:
+            response_cache[key] = body
+            while len(response_cache) > RESPONSE_CACHE_SIZE:
+                response_cache.popitem(last=False)
+    response = app.response_class(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/node', methods=['POST'])
@@ -275,49 +565,163 @@ def get_nodes():
     return jsonify(response), 200
 
 
+@app.route('/nodes/status', methods=['GET'])
+def get_nodes_status():
+    response = {
+        'status': broadcaster.get_status()
+    }
+    return jsonify(response), 200
+
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """Pushes the changes of the chain, the mempool and the peers (see
+    events.py) as Server-Sent Events.
+
+    A reconnecting client resumes after its ``Last-Event-ID`` or
+    ``after``; a new one gets a ``reset`` event and loads the current
+    state. With ``wait`` the events are returned as JSON as soon as there
+    are any, or empty after that many seconds, for long-polling clients.
+    """
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    if 'wait' in request.args:
+        wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_EVENT_WAIT)
+        return jsonify(blockchain.events.wait(after, wait)), 200
+    return app.response_class(stream_events(after), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def stream_events(after):
+    yield 'retry: 3000\n\n'
+    while True:
+        events = blockchain.events.wait(after, EVENT_KEEPALIVE)
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        for event in events:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                event['id'], event['type'], app.json.dumps(event['data']))
+        after = events[-1]['id']
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/download/<file_name>', methods=['GET'])
 def download_file(file_name):
-    try:
-        conn = sqlite3.connect('blockchain-{}.db'.format(port))
-        cursor = conn.cursor()
+    return send_indexed_file(blockchain.storage.find_file(file_name=file_name))
+
+
+@app.route('/download/hash/<file_hash>', methods=['GET'])
+def download_file_by_hash(file_hash):
+    return send_indexed_file(blockchain.storage.find_file(file_hash=file_hash))
+
+
+def send_indexed_file(entry):
+    if entry is None:
+        return jsonify({'message': 'File not found'}), 404
+    if not blockchain.blobs.has(entry['file_hash']):
+        return send_pruned_file(entry)
+    return send_blob(entry['file_hash'], download_name=entry['file_name'], max_age=0)
+
+
+def send_pruned_file(entry):
+    """Fetches a payload this node pruned from a peer and streams it from
+    a temporary file that is removed once the response is closed."""
+    path = blockchain.fetch_payload(entry['file_hash'])
+    if path is None:
+        return jsonify({'message': 'File not found'}), 404
+    response = send_blob(entry['file_hash'], download_name=entry['file_name'], max_age=0, path=path)
+    response.call_on_close(lambda: os.remove(path))
+    return response
+
+
+def send_blob(file_hash, download_name=None, max_age=None, path=None):
+    """Streams a blob from disk in chunks.
+
+    Range requests are answered with partial content so interrupted
+    downloads can be resumed, and the content hash doubles as a strong
+    ETag so clients can re-validate a cached copy with If-None-Match.
+    """
+    return send_file(
+        os.path.abspath(path or blockchain.blobs.blob_path(file_hash)),
+        mimetype='application/octet-stream',
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        conditional=True,
+        etag=file_hash,
+        max_age=max_age)
+
+
+@app.route('/files/<public_key>', methods=['GET'])
+def get_files(public_key):
+    response = {
+        'files': blockchain.storage.get_files(public_key)
+    }
+    return jsonify(response), 200
+
+
+@app.route('/history/<public_key>', methods=['GET'])
+def get_history(public_key):
+    """Returns the confirmed transfers of a participant, newest first,
+    paginated with ``from`` and ``limit``."""
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    response = {
+        'transfers': blockchain.storage.get_history(public_key, start, limit)
+    }
+    return jsonify(response), 200
+
+
+@app.route('/block/<int:index>', methods=['GET'])
+def get_block(index):
+    return send_stored_block(blockchain.storage.get_block(index=index))
+
+
+@app.route('/block/hash/<block_hash>', methods=['GET'])
+def get_block_by_hash(block_hash):
+    return send_stored_block(blockchain.storage.get_block(block_hash=block_hash))
+
+
+def send_stored_block(block):
+    if block is None:
+        return jsonify({'message': 'Block not found'}), 404
+    return jsonify(block), 200
 
-        cursor.execute('SELECT file FROM open_transfers WHERE file_name = ?', (file_name,))
-        row = cursor.fetchone()
-        if row:
-            file_content = row[0]
-        else:
-            cursor.execute('SELECT block_data FROM blockchain')
-            block_data = cursor.fetchall()
-            for row in block_data:
-                block = json.loads(row[0])
-                for tx in block['transfers']:
-                    if tx['file_name'] == file_name:
-                        file_content = tx['file']
-                        break
-                if 'file_content' in locals():
-                    break
-
-        conn.close()
-
-        if 'file_content' in locals():
-            binary_data = base64.b64decode(file_content)
-            response = make_response(binary_data)
-            response.headers['Content-Type'] = 'application/octet-stream'
-            response.headers['Content-Disposition'] = f'attachment; filename={file_name}'
-            return response
-        else:
-            return jsonify({'message': 'File not found'}), 404
 
-    except Exception as e:
-        return jsonify({'message': str(e)}), 500
+@app.route('/blob/<file_hash>', methods=['GET'])
+def get_blob(file_hash):
+    if not blockchain.blobs.has(file_hash):
+        return jsonify({'message': 'File not found'}), 404
+    return send_blob(file_hash, max_age=31536000)
 
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--max-open-transfers', type=int, default=MAX_TRANSFERS)
+    parser.add_argument('--max-open-bytes', type=int, default=MAX_BYTES)
+    parser.add_argument('--prune-depth', type=int,
+                        help='keep file payloads of only this many of the newest blocks')
+    parser.add_argument('--prune-bytes', type=int,
+                        help='keep at most this many bytes of prunable block payloads')
+    parser.add_argument('--archive-node', action='append', default=[],
+                        help='peer to fetch pruned payloads from, can be given more than once')
+    parser.add_argument('--profile-dir',
+                        help='allow ?profile=1 on any request and dump its cProfile stats here')
     args = parser.parse_args()
     port = args.port
+    if args.profile_dir:
+        profile_dir = args.profile_dir
+        os.makedirs(profile_dir, exist_ok=True)
     user = User(port)
-    blockchain = Blockchain(user.public_key, port)
+    blockchain = Blockchain(user.public_key, port, args.max_open_transfers, args.max_open_bytes,
+                            args.prune_depth, args.prune_bytes, args.archive_node)
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from itertools import islice
+
+MAX_TRANSFERS = 10000
+MAX_BYTES = 1024 * 1024 * 1024
+
+
+class Mempool:
+    """The open transfers, keyed by signature in arrival order.
+
+    Inserting, looking up and removing a transfer are dict operations, and
+    a transfer that is already waiting is not added twice. The pool is
+    capped by transfer count and by the total size of the files the
+    transfers carry; when a new transfer does not fit, the oldest ones are
+    evicted to make room.
+    """
+
+    def __init__(self, max_count=MAX_TRANSFERS, max_bytes=MAX_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.__transfers = OrderedDict()
+
+    def __len__(self):
+        return len(self.__transfers)
+
+    def __iter__(self):
+        return iter(list(self.__transfers.values()))
+
+    def __contains__(self, signature):
+        return signature in self.__transfers
+
+    def get(self, signature):
+        return self.__transfers.get(signature)
+
+    def get_range(self, start=0, stop=None):
+        return list(islice(self.__transfers.values(), start, stop))
+
+    def add(self, transfer):
+        """Adds ``transfer`` and returns the transfers evicted for it.
+
+        Returns None if the transfer can never fit, i.e. its file alone is
+        larger than the byte cap.
+        """
+        if transfer.signature in self.__transfers:
+            return []
+        if transfer.file_size > self.max_bytes:
+            return None
+        evicted = []
+        while self.__transfers and (len(self.__transfers) >= self.max_count or
+                                    self.size_bytes + transfer.file_size > self.max_bytes):
+            evicted.append(self.__pop_oldest())
+        self.__transfers[transfer.signature] = transfer
+        self.size_bytes += transfer.file_size
+        return evicted
+
+    def remove(self, signatures):
+        """Removes the transfers with the given signatures and returns the
+        ones that were actually waiting."""
+        removed = []
+        for signature in signatures:
+            transfer = self.__transfers.pop(signature, None)
+            if transfer is not None:
+                self.size_bytes -= transfer.file_size
+                removed.append(transfer)
+        return removed
+
+    def clear(self):
+        self.__transfers.clear()
+        self.size_bytes = 0
+
+    def __pop_oldest(self):
+        signature, transfer = self.__transfers.popitem(last=False)
+        self.size_bytes -= transfer.file_size
+        return transfer
@@ -0,0 +1,156 @@
+"""Counters, gauges and histograms in the Prometheus text format.
+
+Metrics register themselves in ``REGISTRY`` when they are created, and
+``render()`` produces the page served at ``/metrics``.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics = []
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """A value that can go up and down.
+
+    A gauge without labels can instead read its value from a function when
+    it is rendered, see ``set_function``.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.__function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self.__function = function
+
+    def samples(self):
+        if self.__function is not None:
+            try:
+                return ['{} {}'.format(self.name, format_value(self.__function()))]
+            except Exception as e:
+                print('Reading metric {} failed: {}'.format(self.name, e))
+                return []
+        with self._lock:
+            values = dict(self._values)
+        return ['{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value))
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the time spent in the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labels, key, [('le', format_value(bound))]), count))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), counts[-1]))
+        return lines
+
+
+def render():
+    return REGISTRY.render()
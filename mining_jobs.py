@@ -0,0 +1,90 @@
+"""Runs mining in the background so ``/mine`` can answer right away."""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+MAX_FINISHED_JOBS = 100
+
+JOBS = metrics.Counter('mining_jobs_total', 'Mining jobs by outcome.', ['status'])
+
+
+class MiningJob:
+    def __init__(self):
+        self.job_id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.block = None
+        self.message = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'message': self.message,
+            'block': self.block.to_dict() if self.block is not None else None
+        }
+
+
+class MiningJobs:
+    """Mines one block at a time on a dedicated worker thread.
+
+    Jobs are kept in memory until ``MAX_FINISHED_JOBS`` newer jobs have
+    been submitted. ``fn`` returns the mined block or None if mining
+    failed or was abandoned.
+    """
+
+    def __init__(self, max_jobs=MAX_FINISHED_JOBS):
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='miner')
+        self.__jobs = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_jobs = max_jobs
+
+    def submit(self, fn, *args):
+        job = MiningJob()
+        with self.__lock:
+            self.__jobs[job.job_id] = job
+            while len(self.__jobs) > self.__max_jobs:
+                oldest = next(iter(self.__jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                self.__jobs.popitem(last=False)
+        self.__executor.submit(self.__run, job, fn, args)
+        return job
+
+    def get(self, job_id, wait=None):
+        """Returns the job, waiting up to ``wait`` seconds for it to finish,
+        or None if the id is unknown."""
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+        if job is not None and wait:
+            job.done.wait(wait)
+        return job
+
+    def __run(self, job, fn, args):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.block = fn(*args)
+        except Exception as e:
+            print('Mining job {} failed: {}'.format(job.job_id, e))
+            job.message = 'Mining failed.'
+        else:
+            if job.block is not None:
+                job.message = 'Block added successfully.'
+            else:
+                job.message = 'Adding a block failed.'
+        job.status = 'done' if job.block is not None else 'failed'
+        job.finished = time.time()
+        JOBS.inc(status=job.status)
+        job.done.set()
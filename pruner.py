@@ -0,0 +1,102 @@
+"""Evicts old file payloads on pruned nodes."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter
+
+PRUNED = Counter('pruned_payloads_total', 'Payloads evicted from the blob store.')
+PRUNED_BYTES = Counter('pruned_payload_bytes_total', 'Bytes evicted from the blob store.')
+
+
+class Pruner:
+    """Drops the payloads of old blocks, keeping their metadata.
+
+    Headers, transfers and file hashes stay in the database for the whole
+    chain; only the blobs go. A pruned node keeps the payloads of the
+    newest ``depth`` blocks and, with ``max_bytes``, at most that many
+    bytes of prunable payloads. Blocks are pruned oldest first and
+    ``height`` records how far pruning got. The tip is never pruned, so
+    peers can fetch the payloads of the block just announced. A payload
+    still referenced by a newer block or by an open transfer is kept and
+    does not count against ``max_bytes``.
+
+    Without ``depth`` and ``max_bytes`` the node is archival and keeps
+    everything.
+
+    The payloads of a block are looked up and deleted under the write
+    ``lock`` of the chain, so a block or transfer appended meanwhile
+    cannot reference a payload being deleted, and blobs held by the
+    store (uploads not yet in a transfer or block) are skipped.
+    """
+
+    def __init__(self, storage, blobs, lock, depth=None, max_bytes=None):
+        self.storage = storage
+        self.blobs = blobs
+        self.lock = lock
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.height = storage.load_prune_height()
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pruner')
+        self.__lock = threading.Lock()
+        self.__pending = False
+
+    @property
+    def enabled(self):
+        return self.depth is not None or self.max_bytes is not None
+
+    def schedule(self, tip):
+        """Prunes up to the chain tip ``tip`` in the background."""
+        if not self.enabled:
+            return
+        with self.__lock:
+            if self.__pending:
+                return
+            self.__pending = True
+        self.__executor.submit(self.__run, tip)
+
+    def __run(self, tip):
+        with self.__lock:
+            self.__pending = False
+        try:
+            self.prune(tip)
+        except Exception as e:
+            print('Pruning failed: {}'.format(e))
+
+    def prune(self, tip):
+        """Prunes block by block, up to the block below ``tip``, until both
+        limits hold again."""
+        height = min(self.height, self.storage.load_prune_height())
+        last = tip - 1
+        prunable = 0
+        if self.max_bytes is not None:
+            prunable = sum(self.blobs.file_size(file_hash) or 0
+                           for file_hash in self.storage.get_prunable_payloads(height, last))
+        while height < last and self.over_limit(height, tip, prunable):
+            height += 1
+            with self.lock.write():
+                for file_hash in self.storage.get_prunable_payloads(height - 1, height):
+                    freed = self.blobs.delete(file_hash)
+                    if freed:
+                        prunable -= freed
+                        PRUNED.inc()
+                        PRUNED_BYTES.inc(freed)
+        if height != self.height:
+            self.storage.save_prune_height(height)
+            self.height = height
+
+    def over_limit(self, height, tip, prunable):
+        """Tells whether pruning has to go on past ``height``, with
+        ``prunable`` bytes of payloads left that pruning could free."""
+        if self.depth is not None and height < tip - self.depth:
+            return True
+        return self.max_bytes is not None and prunable > self.max_bytes
+
+    def is_pruned(self, index, tip=None):
+        """Tells whether the payloads of block ``index`` are (or, on a
+        chain up to ``tip``, would right away be) pruned."""
+        if not self.enabled:
+            return False
+        if index <= self.height:
+            return True
+        return tip is not None and self.depth is not None and index <= min(tip - self.depth, tip - 1)
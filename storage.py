@@ -0,0 +1,570 @@
+"""Incremental SQLite persistence for a single blockchain node."""
+
+import base64
+import binascii
+import json
+import sqlite3
+import time
+
+from balances import BalanceIndex
+from block import Block
+from database import Database
+from utility.hash_util import hash_legacy_dict
+
+SCHEMA_VERSION = 7
+CHECKPOINTS_KEPT = 3
+SIGNATURE_BATCH = 500
+
+TRANSFER_COLUMNS = ('sender', 'recipient', 'file_name', 'file_hash', 'file_size', 'signature')
+
+
+class Storage:
+    """Append-only store behind ``blockchain-<node_id>.db``.
+
+    Every write touches only the rows that changed (one block, one transfer
+    or one peer) inside a single transaction. Blocks are keyed by their
+    index and open transfers by their signature, so repeating a write never
+    duplicates data. Confirmed transfers are kept one row each, next to
+    their block, so history and file lookups are plain index queries.
+    """
+
+    def __init__(self, node_id, blobs):
+        self.path = 'blockchain-{}.db'.format(node_id)
+        self.blobs = blobs
+        self.db = Database.open(self.path)
+        self.setup()
+
+    def setup(self):
+        """Creates the schema, migrating a legacy database if needed."""
+        migrated = False
+        with self.db.write() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            tables = {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if version < 1 and tables:
+                self._migrate_legacy(conn, tables)
+            if version < 2 and tables:
+                self._migrate_payloads(conn)
+            if version < 4 and tables:
+                self._create_tables(conn)
+                self._migrate_blocks(conn)
+                migrated = True
+            self._create_tables(conn)
+            conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        if migrated:
+            self.db.execute_outside_transaction('VACUUM')
+
+    @staticmethod
+    def _create_tables(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS peer_nodes (
+                node_url TEXT PRIMARY KEY
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blocks (
+                block_index INTEGER PRIMARY KEY,
+                block_hash TEXT UNIQUE,
+                previous_hash TEXT,
+                timestamp,
+                merkle_root TEXT,
+                proof INTEGER,
+                version INTEGER
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS transfers (
+                transfer_id INTEGER PRIMARY KEY,
+                block_index INTEGER REFERENCES blocks (block_index),
+                position INTEGER,
+                sender TEXT,
+                recipient TEXT,
+                file_name TEXT,
+                file_hash TEXT,
+                file_size INTEGER,
+                signature TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS open_transfers (
+                transfer_id INTEGER PRIMARY KEY,
+                sender TEXT,
+                recipient TEXT,
+                file_name TEXT,
+                file_hash TEXT,
+                file_size INTEGER,
+                signature TEXT UNIQUE
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                height INTEGER PRIMARY KEY,
+                block_hash TEXT,
+                balances TEXT,
+                created REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS audit_progress (
+                height INTEGER PRIMARY KEY,
+                block_hash TEXT,
+                updated REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS prune_progress (
+                height INTEGER PRIMARY KEY,
+                updated REAL
+            )
+        ''')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS transfers_block ON transfers (block_index, position)')
+        conn.execute('CREATE INDEX IF NOT EXISTS transfers_sender ON transfers (sender, block_index, position)')
+        conn.execute('CREATE INDEX IF NOT EXISTS transfers_recipient ON transfers (recipient, block_index, position)')
+        conn.execute('CREATE INDEX IF NOT EXISTS transfers_file_name ON transfers (file_name, block_index)')
+        conn.execute('CREATE INDEX IF NOT EXISTS transfers_file_hash ON transfers (file_hash, block_index)')
+        conn.execute('CREATE INDEX IF NOT EXISTS transfers_signature ON transfers (signature, block_index)')
+        conn.execute('CREATE INDEX IF NOT EXISTS open_transfers_sender ON open_transfers (sender)')
+        conn.execute('CREATE INDEX IF NOT EXISTS open_transfers_recipient ON open_transfers (recipient)')
+        conn.execute('CREATE INDEX IF NOT EXISTS open_transfers_file_name ON open_transfers (file_name)')
+        conn.execute('CREATE INDEX IF NOT EXISTS open_transfers_file_hash ON open_transfers (file_hash)')
+
+    @staticmethod
+    def _migrate_legacy(conn, tables):
+        """Compacts a database written by the old full-rewrite save_data.
+
+        The old layout appended the whole chain, a JSON list of peers and
+        every open transfer on each save. Only the first copy of every block
+        index, the most recent peer list and one copy of every still open
+        transfer are kept.
+        """
+        peer_nodes = []
+        if 'peer_nodes' in tables:
+            row = conn.execute(
+                'SELECT node_url FROM peer_nodes ORDER BY node_id DESC LIMIT 1').fetchone()
+            if row:
+                peer_nodes = json.loads(row[0])
+            conn.execute('DROP TABLE peer_nodes')
+
+        blocks = {}
+        if 'blockchain' in tables:
+            for (block_data,) in conn.execute('SELECT block_data FROM blockchain ORDER BY block_id'):
+                block = json.loads(block_data)
+                blocks.setdefault(block['index'], block_data)
+            conn.execute('DROP TABLE blockchain')
+
+        confirmed = set()
+        for block_data in blocks.values():
+            confirmed.update(tx['signature'] for tx in json.loads(block_data)['transfers'])
+
+        open_transfers = []
+        if 'open_transfers' in tables:
+            seen = set()
+            for row in conn.execute('''
+                SELECT sender, recipient, file_name, file, signature
+                FROM open_transfers ORDER BY transfer_id
+            '''):
+                if row[4] in seen or row[4] in confirmed:
+                    continue
+                seen.add(row[4])
+                open_transfers.append(row)
+            conn.execute('DROP TABLE open_transfers')
+
+        conn.execute('CREATE TABLE peer_nodes (node_url TEXT PRIMARY KEY)')
+        conn.execute('CREATE TABLE blockchain (block_id INTEGER PRIMARY KEY, block_data TEXT)')
+        conn.execute('''
+            CREATE TABLE open_transfers (
+                transfer_id INTEGER PRIMARY KEY,
+                sender TEXT,
+                recipient TEXT,
+                file_name TEXT,
+                file BLOB,
+                signature TEXT UNIQUE
+            )
+        ''')
+        conn.executemany('INSERT INTO peer_nodes (node_url) VALUES (?)',
+                         [(node,) for node in peer_nodes])
+        conn.executemany('INSERT INTO blockchain (block_id, block_data) VALUES (?, ?)',
+                         sorted(blocks.items()))
+        conn.executemany('''
+            INSERT INTO open_transfers (sender, recipient, file_name, file, signature)
+            VALUES (?, ?, ?, ?, ?)
+        ''', open_transfers)
+
+    def _migrate_payloads(self, conn):
+        """Moves base64 file payloads out of the database into the blob store.
+
+        Transfers are rewritten to carry only ``file_hash`` and ``file_size``.
+        Blocks received from peers before this version could have ``file``
+        and ``file_name`` swapped; those are put back in order here. The
+        hash of a block covers the base64 payloads, so it is recorded as
+        ``hash`` before they are removed.
+        """
+        rows = conn.execute('SELECT block_id, block_data FROM blockchain').fetchall()
+        for block_id, block_data in rows:
+            block = json.loads(block_data)
+            if block.get('version', 0) == 0:
+                block['hash'] = hash_legacy_dict(block)
+            for tx in block['transfers']:
+                self._move_payload(tx)
+            conn.execute('UPDATE blockchain SET block_data = ? WHERE block_id = ?',
+                         (json.dumps(block), block_id))
+
+        open_transfers = []
+        for row in conn.execute('''
+            SELECT sender, recipient, file_name, file, signature
+            FROM open_transfers ORDER BY transfer_id
+        '''):
+            tx = dict(zip(('sender', 'recipient', 'file_name', 'file', 'signature'), row))
+            self._move_payload(tx)
+            open_transfers.append(tx)
+        conn.execute('DROP TABLE open_transfers')
+        self._create_tables(conn)
+        conn.executemany('''
+            INSERT INTO open_transfers (sender, recipient, file_name, file_hash, file_size, signature)
+            VALUES (:sender, :recipient, :file_name, :file_hash, :file_size, :signature)
+        ''', open_transfers)
+
+    def _move_payload(self, tx):
+        if 'file' not in tx:
+            return
+        payload = tx.pop('file')
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        try:
+            data = base64.b64decode(payload, validate=True)
+        except binascii.Error:
+            data = base64.b64decode(tx['file_name'])
+            tx['file_name'] = payload
+        tx['file_hash'], tx['file_size'] = self.blobs.put(data)
+
+    def _migrate_blocks(self, conn):
+        """Splits the JSON blocks of schema version 3 and older into the
+        ``blocks`` and ``transfers`` tables.
+
+        Blocks keep the hash recorded by ``_migrate_payloads``, and the
+        migrated chain is checkpointed as far as its blocks link up, since
+        the proofs and signatures of version 0 blocks covered the removed
+        payloads and cannot be checked again.
+        """
+        blocks = []
+        for (block_data,) in conn.execute('SELECT block_data FROM blockchain ORDER BY block_id').fetchall():
+            block = json.loads(block_data)
+            blocks.append(Block.from_dict(block, trusted='hash' in block))
+        self._insert_blocks(conn, blocks)
+        conn.execute('DROP TABLE blockchain')
+        conn.execute('DROP TABLE IF EXISTS file_index')
+
+        linked = blocks[:1]
+        for block in blocks[1:]:
+            if block.index != linked[-1].index + 1 or block.previous_hash != linked[-1].hash:
+                print('Migrated chain does not link up after block {}'.format(linked[-1].index))
+                break
+            linked.append(block)
+        if len(linked) > 1:
+            balances = BalanceIndex()
+            balances.rebuild(linked, [])
+            self.save_checkpoint(linked[-1].index, linked[-1].hash, balances.snapshot())
+
+    @staticmethod
+    def _insert_blocks(conn, blocks):
+        conn.executemany('''
+            INSERT INTO blocks
+                (block_index, block_hash, previous_hash, timestamp, merkle_root, proof, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(block.index, block.hash, block.previous_hash, block.timestamp,
+               block.merkle_root, block.proof, block.version) for block in blocks])
+        conn.executemany('''
+            INSERT INTO transfers
+                (block_index, position, sender, recipient, file_name, file_hash, file_size, signature)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(block.index, position, tx.sender, tx.recipient, tx.file_name,
+               tx.file_hash, tx.file_size, tx.signature)
+              for block in blocks for position, tx in enumerate(block.transfers)])
+        conn.executemany('DELETE FROM open_transfers WHERE signature = ?',
+                         [(tx.signature,) for block in blocks for tx in block.transfers])
+
+    @staticmethod
+    def _delete_blocks_from(conn, height):
+        conn.execute('DELETE FROM checkpoints WHERE height >= ?', (height,))
+        conn.execute('DELETE FROM audit_progress WHERE height >= ?', (height,))
+        conn.execute('UPDATE prune_progress SET height = ? WHERE height >= ?', (max(height - 1, 0), height))
+        conn.execute('DELETE FROM transfers WHERE block_index >= ?', (height,))
+        conn.execute('DELETE FROM blocks WHERE block_index >= ?', (height,))
+
+    def _query(self, sql, params=()):
+        with self.db.read() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            return [dict(row) for row in cursor.execute(sql, params).fetchall()]
+
+    def find_file(self, file_name=None, file_hash=None):
+        """Looks up a file by name or digest with a single indexed query.
+
+        Files still waiting in the mempool win over confirmed ones, and
+        older blocks win over newer ones. Returns a dict or None.
+        """
+        column = 'file_name' if file_name is not None else 'file_hash'
+        value = file_name if file_name is not None else file_hash
+        rows = self._query('''
+            SELECT * FROM (
+                SELECT * FROM (
+                    SELECT file_name, file_hash, file_size, sender, recipient, NULL AS block_index
+                    FROM open_transfers WHERE {0} = ? LIMIT 1
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT file_name, file_hash, file_size, sender, recipient, block_index
+                    FROM transfers WHERE {0} = ? ORDER BY block_index LIMIT 1
+                )
+            )
+            ORDER BY block_index IS NOT NULL, block_index LIMIT 1
+        '''.format(column), (value, value))
+        return rows[0] if rows else None
+
+    def get_files(self, participant):
+        """Lists all files sent to or received by the given public key."""
+        return self._query('''
+            SELECT file_name, file_hash, file_size, sender, recipient, block_index
+            FROM transfers WHERE sender = ?
+            UNION ALL
+            SELECT file_name, file_hash, file_size, sender, recipient, block_index
+            FROM transfers WHERE recipient = ? AND sender != ?
+            UNION ALL
+            SELECT file_name, file_hash, file_size, sender, recipient, NULL
+            FROM open_transfers WHERE sender = ?
+            UNION ALL
+            SELECT file_name, file_hash, file_size, sender, recipient, NULL
+            FROM open_transfers WHERE recipient = ? AND sender != ?
+        ''', (participant,) * 6)
+
+    def get_history(self, participant, offset=0, limit=None):
+        """Returns the confirmed transfers sent or received by the given
+        public key, newest first."""
+        return self._query('''
+            SELECT block_index, position, sender, recipient, file_name, file_hash, file_size, signature
+            FROM transfers WHERE sender = ?
+            UNION ALL
+            SELECT block_index, position, sender, recipient, file_name, file_hash, file_size, signature
+            FROM transfers WHERE recipient = ? AND sender != ?
+            ORDER BY block_index DESC, position DESC
+            LIMIT ? OFFSET ?
+        ''', (participant, participant, participant, -1 if limit is None else limit, offset))
+
+    def get_block(self, index=None, block_hash=None):
+        """Looks up a block with its transfers by index or by hash.
+
+        Returns the block dict including its ``hash`` or None.
+        """
+        column = 'block_index' if index is not None else 'block_hash'
+        rows = self._query('''
+            SELECT block_index, block_hash, previous_hash, timestamp, merkle_root, proof, version
+            FROM blocks WHERE {} = ?
+        '''.format(column), (index if index is not None else block_hash,))
+        if not rows:
+            return None
+        block = self._block_dict(rows[0])
+        block['transfers'] = self._query('''
+            SELECT sender, recipient, file_name, file_hash, file_size, signature
+            FROM transfers WHERE block_index = ? ORDER BY position
+        ''', (block['index'],))
+        return block
+
+    @staticmethod
+    def _block_dict(row):
+        block = dict(row)
+        block['index'] = block.pop('block_index')
+        block['hash'] = block.pop('block_hash')
+        return block
+
+    def load_peer_nodes(self):
+        with self.db.read() as conn:
+            rows = conn.execute('SELECT node_url FROM peer_nodes').fetchall()
+        return [row[0] for row in rows]
+
+    def load_blocks(self):
+        """Returns all blocks as dicts, in order and with their transfers.
+
+        Blocks and transfers are read in one transaction, so both come from
+        the same snapshot even while a node appends blocks.
+        """
+        with self.db.read() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute('BEGIN')
+            try:
+                blocks = [self._block_dict(row) for row in cursor.execute('''
+                    SELECT block_index, block_hash, previous_hash, timestamp, merkle_root, proof, version
+                    FROM blocks ORDER BY block_index
+                ''').fetchall()]
+                by_index = {}
+                for block in blocks:
+                    block['transfers'] = []
+                    by_index[block['index']] = block
+                for row in conn.execute('''
+                    SELECT block_index, sender, recipient, file_name, file_hash, file_size, signature
+                    FROM transfers ORDER BY block_index, position
+                '''):
+                    by_index[row[0]]['transfers'].append(dict(zip(TRANSFER_COLUMNS, row[1:])))
+            finally:
+                conn.execute('COMMIT')
+        return blocks
+
+    def load_chain(self, trusted_height=0):
+        """Returns all blocks as Block objects.
+
+        Blocks up to ``trusted_height`` keep their stored hash, and so do
+        version 0 blocks, whose hash was recorded when the database was
+        migrated (see ``_migrate_payloads``) and cannot be recomputed.
+        """
+        return [Block.from_dict(block, trusted=block['index'] <= trusted_height or block['version'] == 0)
+                for block in self.load_blocks()]
+
+    def load_open_transfers(self):
+        return self._query('''
+            SELECT sender, recipient, file_name, file_hash, file_size, signature
+            FROM open_transfers ORDER BY transfer_id
+        ''')
+
+    def load_checkpoint(self):
+        """Returns the newest checkpoint that still matches the stored
+        chain as a dict with ``height``, ``block_hash`` and ``balances``,
+        or None."""
+        rows = self._query('''
+            SELECT checkpoints.height, checkpoints.block_hash, checkpoints.balances
+            FROM checkpoints JOIN blocks
+                ON blocks.block_index = checkpoints.height AND blocks.block_hash = checkpoints.block_hash
+            ORDER BY checkpoints.height DESC LIMIT 1
+        ''')
+        if not rows:
+            return None
+        checkpoint = rows[0]
+        checkpoint['balances'] = json.loads(checkpoint['balances'])
+        return checkpoint
+
+    def save_checkpoint(self, height, block_hash, balances):
+        """Marks the chain up to ``height`` as verified, together with the
+        balances at that height. Only the newest few checkpoints are kept."""
+        with self.db.write() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO checkpoints (height, block_hash, balances, created)
+                VALUES (?, ?, ?, ?)
+            ''', (height, block_hash, json.dumps(balances, separators=(',', ':')), time.time()))
+            conn.execute('''
+                DELETE FROM checkpoints WHERE height NOT IN
+                    (SELECT height FROM checkpoints ORDER BY height DESC LIMIT ?)
+            ''', (CHECKPOINTS_KEPT,))
+
+    def load_audit_progress(self):
+        """Returns the height up to which a full audit of the stored chain
+        got, or 0 if none ran or the chain changed below it since."""
+        with self.db.read() as conn:
+            row = conn.execute('''
+                SELECT audit_progress.height FROM audit_progress JOIN blocks
+                    ON blocks.block_index = audit_progress.height AND blocks.block_hash = audit_progress.block_hash
+            ''').fetchone()
+        return row[0] if row else 0
+
+    def save_audit_progress(self, height, block_hash):
+        with self.db.write() as conn:
+            conn.execute('DELETE FROM audit_progress')
+            conn.execute('INSERT INTO audit_progress (height, block_hash, updated) VALUES (?, ?, ?)',
+                         (height, block_hash, time.time()))
+
+    def load_prune_height(self):
+        """Returns the height up to which payloads were pruned, or 0."""
+        with self.db.read() as conn:
+            row = conn.execute('SELECT height FROM prune_progress').fetchone()
+        return row[0] if row else 0
+
+    def save_prune_height(self, height):
+        with self.db.write() as conn:
+            conn.execute('DELETE FROM prune_progress')
+            conn.execute('INSERT INTO prune_progress (height, updated) VALUES (?, ?)', (height, time.time()))
+
+    def get_prunable_payloads(self, height, last):
+        """Returns the payload digests that pruning the blocks after
+        ``height`` up to ``last`` frees: those the blocks refer to and no
+        newer block and no open transfer does."""
+        with self.db.read() as conn:
+            rows = conn.execute('''
+                SELECT DISTINCT file_hash FROM transfers AS t
+                WHERE block_index > ? AND block_index <= ?
+                    AND NOT EXISTS (SELECT 1 FROM transfers
+                                    WHERE file_hash = t.file_hash AND block_index > ?)
+                    AND NOT EXISTS (SELECT 1 FROM open_transfers WHERE file_hash = t.file_hash)
+            ''', (height, last, last)).fetchall()
+        return [row[0] for row in rows]
+
+    def find_confirmed(self, signatures, height=None):
+        """Returns those of ``signatures`` that a block up to ``height``
+        (by default any block) confirms."""
+        signatures = list(signatures)
+        below = '' if height is None else 'AND block_index <= ?'
+        confirmed = set()
+        with self.db.read() as conn:
+            for start in range(0, len(signatures), SIGNATURE_BATCH):
+                batch = signatures[start:start + SIGNATURE_BATCH]
+                confirmed.update(row[0] for row in conn.execute('''
+                    SELECT signature FROM transfers
+                    WHERE signature IN ({}) AND sender != 'SYSTEM' {}
+                '''.format(', '.join('?' * len(batch)), below), batch + ([] if height is None else [height])))
+        return confirmed
+
+    def is_referenced(self, file_hash):
+        """Tells whether a block or an open transfer refers to a payload."""
+        with self.db.read() as conn:
+            row = conn.execute('''
+                SELECT EXISTS (SELECT 1 FROM transfers WHERE file_hash = ?)
+                    OR EXISTS (SELECT 1 FROM open_transfers WHERE file_hash = ?)
+            ''', (file_hash, file_hash)).fetchone()
+        return bool(row[0])
+
+    def add_peer_node(self, node):
+        with self.db.write() as conn:
+            conn.execute('INSERT OR IGNORE INTO peer_nodes (node_url) VALUES (?)', (node,))
+
+    def remove_peer_node(self, node):
+        with self.db.write() as conn:
+            conn.execute('DELETE FROM peer_nodes WHERE node_url = ?', (node,))
+
+    def add_open_transfer(self, transfer):
+        with self.db.write() as conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO open_transfers
+                    (sender, recipient, file_name, file_hash, file_size, signature)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (transfer.sender, transfer.recipient, transfer.file_name,
+                  transfer.file_hash, transfer.file_size, transfer.signature))
+
+    def remove_open_transfers(self, signatures):
+        with self.db.write() as conn:
+            conn.executemany('DELETE FROM open_transfers WHERE signature = ?',
+                             [(signature,) for signature in signatures])
+
+    def append_block(self, block):
+        """Stores one new block and drops the open transfers it confirms."""
+        with self.db.write() as conn:
+            self._delete_blocks_from(conn, block.index)
+            self._insert_blocks(conn, [block])
+
+    def replace_blocks_from(self, height, blocks):
+        """Drops all blocks from ``height`` on and appends ``blocks`` instead."""
+        with self.db.write() as conn:
+            self._delete_blocks_from(conn, height)
+            self._insert_blocks(conn, blocks)
+
+
+if __name__ == '__main__':
+    import sys
+    from argparse import ArgumentParser
+    from blob_store import BlobStore
+    from utility.verification import Verification
+    parser = ArgumentParser(description='Compact a legacy blockchain-<port>.db file and check the migrated chain.')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    args = parser.parse_args()
+    storage = Storage(args.port, BlobStore(args.port))
+    print('blockchain-{}.db is up to date (schema version {})'.format(args.port, SCHEMA_VERSION))
+    if not Verification.verify_chain(storage.load_chain()):
+        print('The migrated chain does not verify')
+        sys.exit(1)
+    print('The migrated chain verifies')
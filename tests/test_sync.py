@@ -0,0 +1,137 @@
+"""Tests for syncing a chain from a peer with Blockchain.resolve()."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+from blockchain import Blockchain
+from broadcaster import broadcaster
+from users import User
+
+PEER = 'peer.test:5000'
+
+
+class FakeResponse:
+    def __init__(self, body=None, status_code=200, content=None):
+        self.body = body
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakePeer:
+    """Answers the requests resolve() makes to a peer from plain lists of
+    header and block dicts and a dict of payloads."""
+
+    def __init__(self, headers, blocks, payloads=None):
+        self.headers = headers
+        self.blocks = blocks
+        self.payloads = payloads or {}
+
+    def get(self, url, params=None, **kwargs):
+        path = url.split(PEER, 1)[1]
+        start = (params or {}).get('from', 0)
+        if path == '/headers':
+            return FakeResponse([header for header in self.headers if header['index'] >= start])
+        if path == '/blocks':
+            return FakeResponse([block for block in self.blocks if block['index'] >= start])
+        if path.startswith('/blob/'):
+            payload = self.payloads.get(path[len('/blob/'):])
+            if payload is None:
+                return FakeResponse(status_code=404)
+            return FakeResponse(content=payload)
+        return FakeResponse(status_code=404)
+
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='blockchain-test-')
+        os.chdir(self.workdir)
+        self.user = User('test')
+        self.user.private_key, self.user.public_key = User.generate_keys()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def new_node(self):
+        return Blockchain(self.user.public_key, 'test-{}'.format(uuid.uuid4().hex))
+
+    def mine(self, blockchain, count):
+        for position in range(count):
+            file_hash, file_size = blockchain.blobs.put(os.urandom(64))
+            self.assertIsNotNone(blockchain.mine_block(file_hash, 'reward-{}.bin'.format(position), file_size))
+
+    def resolve(self, blockchain, peer):
+        blockchain.add_peer_node(PEER)
+        with mock.patch.object(broadcaster, 'session', return_value=peer):
+            return blockchain.resolve()
+
+    def test_rejects_forged_version_0_branch(self):
+        blockchain = self.new_node()
+        self.mine(blockchain, 2)
+        genesis = blockchain.get_blocks(0, 1)[0]
+        victim_key = User.generate_keys()[1]
+        headers = [dict(genesis.header(), hash=genesis.hash)]
+        blocks = [dict(genesis.to_dict(), hash=genesis.hash)]
+        for index in range(1, 8):
+            forged_hash = '{:064x}'.format(index)
+            transfers = [{'sender': victim_key, 'recipient': self.user.public_key, 'file_name': 'forged',
+                          'file_hash': '0' * 64, 'file_size': 1, 'signature': forged_hash},
+                         {'sender': 'SYSTEM', 'recipient': self.user.public_key, 'file_name': '',
+                          'file_hash': '1' * 64, 'file_size': 1, 'signature': ''}]
+            block = {'index': index, 'previous_hash': headers[-1]['hash'], 'timestamp': 0, 'proof': 0,
+                     'version': 0, 'merkle_root': None, 'hash': forged_hash, 'transfers': transfers}
+            headers.append({key: value for key, value in block.items() if key != 'transfers'})
+            blocks.append(block)
+
+        self.assertFalse(self.resolve(blockchain, FakePeer(headers, blocks)))
+        tip = blockchain.get_last_blockchain_value()
+        self.assertEqual((tip.index, tip.version), (2, 1))
+        self.assertEqual(blockchain.get_balance(victim_key), 0)
+
+    def test_syncs_longer_valid_branch(self):
+        peer = self.new_node()
+        self.mine(peer, 3)
+        blockchain = self.new_node()
+        self.mine(blockchain, 1)
+        blocks = peer.get_blocks()
+        payloads = {tx.file_hash: peer.blobs.get(tx.file_hash) for block in blocks for tx in block.transfers}
+
+        fake_peer = FakePeer(peer.get_headers(), [block.to_dict() for block in blocks], payloads)
+        self.assertTrue(self.resolve(blockchain, fake_peer))
+        self.assertEqual(blockchain.get_last_blockchain_value().hash, peer.get_last_blockchain_value().hash)
+        for file_hash in payloads:
+            self.assertTrue(blockchain.blobs.has(file_hash))
+
+    def test_rejects_branch_with_missing_payload(self):
+        peer = self.new_node()
+        self.mine(peer, 3)
+        blockchain = self.new_node()
+        self.mine(blockchain, 1)
+        tip = blockchain.get_last_blockchain_value()
+        blocks = peer.get_blocks()
+        payloads = {tx.file_hash: peer.blobs.get(tx.file_hash) for block in blocks for tx in block.transfers}
+        missing = blocks[-1].transfers[-1].file_hash
+        del payloads[missing]
+
+        fake_peer = FakePeer(peer.get_headers(), [block.to_dict() for block in blocks], payloads)
+        self.assertFalse(self.resolve(blockchain, fake_peer))
+        self.assertIs(blockchain.get_last_blockchain_value(), tip)
+        self.assertFalse(blockchain.blobs.has(missing))
+        for file_hash in payloads:
+            self.assertFalse(blockchain.blobs.has(file_hash))
+
+
+if __name__ == '__main__':
+    unittest.main()
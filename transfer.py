@@ -1,5 +1,7 @@
+import sys
 from collections import OrderedDict
 
+from utility.hash_util import is_digest
 from utility.printable import Printable
 
 
@@ -10,19 +12,57 @@ class Transfer(Printable):
         :sender: The sender of the files.
         :recipient: The recipient of the files.
         :signature: The signature of the transfer.
-        :file: The transfer file.
+        :file_name: The name of the transferred file.
+        :file_hash: The SHA-256 digest of the file in the blob store.
+        :file_size: The size of the file in bytes.
+
+    Transfers only reference their file by ``file_hash``; the content stays
+    in the blob store until it is asked for. Public keys repeat across many
+    transfers and are interned, so each distinct key is held once.
     """
+    __slots__ = ('sender', 'recipient', 'file_name', 'file_hash', 'file_size', 'signature')
 
-    def __init__(self, sender, recipient, signature, file, file_name):
-        self.sender = sender
-        self.recipient = recipient
+    def __init__(self, sender, recipient, signature, file_hash, file_name, file_size):
+        self.sender = sys.intern(sender)
+        self.recipient = sys.intern(recipient)
         self.file_name = file_name
-        self.file = file
+        self.file_hash = file_hash
+        self.file_size = file_size
         self.signature = signature
 
+    @classmethod
+    def from_dict(cls, tx):
+        """Creates a transfer from its dict form (e.g. parsed JSON).
+
+        Raises ValueError if ``file_hash`` is not a SHA-256 digest or
+        another field has the wrong type, as it may come from a peer.
+        """
+        if not is_digest(tx['file_hash']):
+            raise ValueError('Malformed file hash')
+        if not all(isinstance(tx[key], str) for key in ('sender', 'recipient', 'file_name', 'signature')):
+            raise ValueError('Malformed transfer')
+        if not isinstance(tx['file_size'], int) or isinstance(tx['file_size'], bool):
+            raise ValueError('Malformed file size')
+        return cls(sender=tx['sender'],
+                   recipient=tx['recipient'],
+                   signature=tx['signature'],
+                   file_hash=tx['file_hash'],
+                   file_name=tx['file_name'],
+                   file_size=tx['file_size'])
+
+    def to_dict(self):
+        """Converts this transfer into a JSON serializable dict."""
+        return {'sender': self.sender,
+                'recipient': self.recipient,
+                'file_name': self.file_name,
+                'file_hash': self.file_hash,
+                'file_size': self.file_size,
+                'signature': self.signature}
+
     def to_ordered_dict(self):
         """Converts this transfer into a (hashable) OrderedDict."""
         return OrderedDict([('sender', self.sender),
                             ('recipient', self.recipient),
                             ('file_name', self.file_name),
-                            ('file', self.file)])
+                            ('file_hash', self.file_hash),
+                            ('file_size', self.file_size)])
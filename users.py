@@ -3,7 +3,61 @@ from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 import Crypto.Random
 import binascii
-import sqlite3
+import hashlib as hl
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from database import Database
+from metrics import Counter
+from utility.process_pool import WORKERS, get_executor
+
+KEY_CACHE_SIZE = 1024
+VERIFIED_CACHE_SIZE = 65536
+BATCH_THRESHOLD = 16
+
+SIGNATURE_CHECKS = Counter('signature_checks_total', 'Transfer signature checks by outcome.', ['result'])
+
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def import_public_key(public_key):
+    """Parses a hex encoded public key once and keeps the RSA object."""
+    return RSA.importKey(binascii.unhexlify(public_key))
+
+
+def verify_signature(sender, recipient, file_name, file_hash, signature):
+    try:
+        verifier = PKCS1_v1_5.new(import_public_key(sender))
+        h = SHA256.new((str(sender) + str(recipient)).encode('utf8'))
+        h.update((file_name + file_hash).encode('utf-8'))
+        return verifier.verify(h, binascii.unhexlify(signature))
+    except (ValueError, TypeError, IndexError, binascii.Error):
+        return False
+
+
+def _signature_fields(transfer):
+    return (transfer.sender, transfer.recipient, transfer.file_name,
+            transfer.file_hash, transfer.signature)
+
+
+def _signature_digest(fields):
+    return hl.sha256('\x00'.join(str(field) for field in fields).encode('utf-8')).digest()
+
+
+def _remember_verified(digest):
+    with _verified_lock:
+        _verified[digest] = True
+        _verified.move_to_end(digest)
+        if len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+
+def _is_verified(digest):
+    with _verified_lock:
+        return digest in _verified
 
 
 class User:
@@ -22,35 +76,23 @@ class User:
         return True
 
     def save_keys_to_database(self):
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                node_id TEXT PRIMARY KEY,
-                public_key TEXT,
-                private_key TEXT
-            )
-        ''')
-
-        res = cursor.execute('SELECT node_id FROM users WHERE node_id = ?', (self.node_id,))
-        row = res.fetchone()
-
-        if row is None:
-            cursor.execute('''
-                INSERT INTO users (node_id, public_key, private_key)
+        with Database.open('users.db').write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    node_id TEXT PRIMARY KEY,
+                    public_key TEXT,
+                    private_key TEXT
+                )
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO users (node_id, public_key, private_key)
                 VALUES (?, ?, ?)
             ''', (self.node_id, self.public_key, self.private_key))
 
-        conn.commit()
-        conn.close()
-
     def load_keys_from_database(self):
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT public_key, private_key FROM users WHERE node_id = ?', (self.node_id,))
-        row = cursor.fetchone()
+        with Database.open('users.db').read() as conn:
+            row = conn.execute('SELECT public_key, private_key FROM users WHERE node_id = ?',
+                               (self.node_id,)).fetchone()
 
         conditional = False
         if row:
@@ -58,7 +100,6 @@ class User:
             self.private_key = row[1]
             conditional = True
 
-        conn.close()
         return conditional
 
     @staticmethod
@@ -74,21 +115,49 @@ class User:
             .decode('ascii')
         )
 
-    def sign_transfer(self, sender, recipient, file):
+    def sign_transfer(self, sender, recipient, file_name, file_hash):
         private_key = RSA.importKey(binascii.unhexlify(self.private_key))
         h = SHA256.new((str(sender) + str(recipient)).encode('utf8'))
-        h.update(file.encode('utf-8'))
+        h.update((file_name + file_hash).encode('utf-8'))
         signature = PKCS1_v1_5.new(private_key).sign(h)
         return binascii.hexlify(signature).decode('ascii')
 
     @staticmethod
     def verify_transfer(transfer):
-        public_key = RSA.importKey(binascii.unhexlify(transfer.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(transfer.sender) + str(transfer.recipient)).encode('utf8'))
-        file = transfer.file
-        h.update(file.encode('utf-8'))
-        if verifier.verify(h, transfer.signature) == 0:
+        fields = _signature_fields(transfer)
+        digest = _signature_digest(fields)
+        if _is_verified(digest):
+            SIGNATURE_CHECKS.inc(result='cached')
+            return True
+        if verify_signature(*fields):
+            SIGNATURE_CHECKS.inc(result='valid')
+            _remember_verified(digest)
             return True
+        SIGNATURE_CHECKS.inc(result='invalid')
+        return False
+
+    @staticmethod
+    def verify_transfers(transfers):
+        """Verifies many transfers at once, returning one bool per transfer.
+
+        Signatures seen before are answered from the memo. The rest are
+        checked on the process pool when there are enough of them to make
+        up for the overhead.
+        """
+        fields = [_signature_fields(tx) for tx in transfers]
+        digests = [_signature_digest(f) for f in fields]
+        results = [_is_verified(digest) for digest in digests]
+        pending = [i for i, result in enumerate(results) if not result]
+        SIGNATURE_CHECKS.inc(len(results) - len(pending), result='cached')
+        if len(pending) >= BATCH_THRESHOLD and WORKERS > 1:
+            chunksize = max(1, len(pending) // (WORKERS * 4))
+            checked = get_executor().map(verify_signature, *zip(*[fields[i] for i in pending]),
+                                         chunksize=chunksize)
         else:
-            return False
+            checked = (verify_signature(*fields[i]) for i in pending)
+        for i, result in zip(pending, checked):
+            if result:
+                _remember_verified(digests[i])
+            SIGNATURE_CHECKS.inc(result='valid' if result else 'invalid')
+            results[i] = result
+        return results
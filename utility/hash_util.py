@@ -1,12 +1,68 @@
 import hashlib as hl
 import json
+import re
+
+EMPTY_MERKLE_ROOT = '0' * 64
+_DIGEST = re.compile('[0-9a-f]{64}')
+
+
+def is_digest(value):
+    """Tells whether ``value`` is a lowercase hex SHA-256 digest."""
+    return isinstance(value, str) and _DIGEST.fullmatch(value) is not None
 
 
 def hash_string_256(string):
     return hl.sha256(string).hexdigest()
 
 
-def hash_block(block):
-    hashable_block = block.__dict__.copy()
-    hashable_block['transfers'] = [tx.to_ordered_dict() for tx in hashable_block['transfers']]
+def hash_transfer(transfer):
+    """Hashes every field of a transfer, including its signature."""
+    return hash_string_256(json.dumps(
+        [transfer.sender, transfer.recipient, transfer.file_name,
+         transfer.file_hash, transfer.file_size, transfer.signature]).encode())
+
+
+def merkle_root(transfers):
+    """Builds the Merkle root over the transfer hashes.
+
+    An odd node on a level is paired with itself, as in Bitcoin.
+    """
+    level = [hash_transfer(tx) for tx in transfers]
+    if not level:
+        return EMPTY_MERKLE_ROOT
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hash_string_256((level[i] + level[i + 1]).encode())
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def hash_header(header):
+    return hash_string_256(json.dumps(header, sort_keys=True).encode())
+
+
+def hash_legacy_block(block):
+    """Hashes a version 0 block the way it was done before block headers:
+    the whole block, every transfer included."""
+    return hash_legacy_dict({
+        'index': block.index,
+        'previous_hash': block.previous_hash,
+        'timestamp': block.timestamp,
+        'transfers': [tx.to_ordered_dict() for tx in block.transfers],
+        'proof': block.proof
+    })
+
+
+def hash_legacy_dict(block):
+    """Hashes a version 0 block given as a dict. Transfers stored before
+    the blob store carry their base64 payload as ``file`` and are hashed
+    with it, without their signature."""
+    hashable_block = {key: block[key] for key in ('index', 'previous_hash', 'timestamp', 'proof')}
+    hashable_block['transfers'] = [{key: value for key, value in tx.items() if key != 'signature'}
+                                   for tx in block['transfers']]
     return hash_string_256(json.dumps(hashable_block, sort_keys=True).encode())
+
+
+def hash_block(block):
+    return block.hash
@@ -0,0 +1,97 @@
+"""Provides the proof of work search used for mining."""
+
+import hashlib as hl
+import json
+import threading
+import time
+
+from metrics import Counter, Gauge, Histogram
+from utility.process_pool import WORKERS, get_executor
+
+BATCH_SIZE = 4096
+
+NONCES = Counter('pow_nonces_total', 'Proof of work guesses tried.')
+SEARCH_SECONDS = Histogram('pow_search_seconds', 'Duration of proof of work searches.', ['result'])
+HASH_RATE = Gauge('pow_hash_rate', 'Guesses per second of the last proof of work search.')
+
+
+def header_prefix(header):
+    """Serializes everything a proof guess for a block contains except the
+    proof itself: its whole header (see ``Block.header``), so a proof is
+    only valid for one index, timestamp and version."""
+    fields = {key: value for key, value in header.items() if key != 'proof'}
+    return json.dumps(fields, sort_keys=True).encode()
+
+
+def is_valid_digest(digest):
+    """Matches the ``hexdigest()[0:2] == '00'`` difficulty check."""
+    return digest[0] == 0
+
+
+def search_range(prefix, start, stop):
+    """Returns the lowest valid proof in ``[start, stop)`` or None."""
+    midstate = hl.sha256(prefix)
+    for proof in range(start, stop):
+        guess = midstate.copy()
+        guess.update(str(proof).encode())
+        if is_valid_digest(guess.digest()):
+            return proof
+    return None
+
+
+class ProofOfWork:
+    """Searches proofs in batches, hashing the shared prefix only once.
+
+    The first batch runs in the calling thread, which is enough for the
+    current difficulty almost every time. Further batches are spread over a
+    process pool. The lowest valid proof is always returned, so the result
+    is the same as the plain sequential search.
+    """
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE):
+        self.workers = workers or WORKERS
+        self.batch_size = batch_size
+        self.__cancelled = threading.Event()
+
+    def cancel(self):
+        """Stops a running search, e.g. because a peer's block arrived first."""
+        self.__cancelled.set()
+
+    def search(self, prefix):
+        """Returns a valid proof for ``prefix`` (see ``header_prefix``), or
+        None if the search was cancelled."""
+        started = time.perf_counter()
+        proof, tried = self.__search(prefix)
+        elapsed = time.perf_counter() - started
+        NONCES.inc(tried)
+        SEARCH_SECONDS.observe(elapsed, result='cancelled' if proof is None else 'found')
+        if elapsed > 0:
+            HASH_RATE.set(tried / elapsed)
+        return proof
+
+    def __search(self, prefix):
+        """Returns the proof (or None) and the number of guesses hashed."""
+        self.__cancelled.clear()
+        proof = search_range(prefix, 0, self.batch_size)
+        if proof is not None:
+            return proof, proof + 1
+        start = self.batch_size
+        while proof is None:
+            if self.__cancelled.is_set():
+                return None, start
+            if self.workers == 1:
+                proof = search_range(prefix, start, start + self.batch_size)
+                start += self.batch_size
+                continue
+            executor = get_executor()
+            futures = [
+                executor.submit(search_range, prefix,
+                                start + i * self.batch_size,
+                                start + (i + 1) * self.batch_size)
+                for i in range(self.workers)
+            ]
+            found = [proof for proof in (future.result() for future in futures) if proof is not None]
+            if found:
+                proof = min(found)
+            start += self.workers * self.batch_size
+        return proof, start
@@ -1,4 +1,9 @@
 class Printable:
     """A base class which implements printing functionality."""
+    __slots__ = ()
+
     def __repr__(self):
-        return str(self.__dict__)
+        return str({name: getattr(self, name)
+                    for cls in reversed(type(self).__mro__)
+                    for name in getattr(cls, '__slots__', ())
+                    if not name.startswith('_')})
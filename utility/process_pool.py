@@ -0,0 +1,19 @@
+"""Provides the process pool shared by CPU-bound helpers."""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+WORKERS = os.cpu_count() or 1
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the node-wide process pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=WORKERS)
+        return _executor
@@ -0,0 +1,71 @@
+"""Provides a readers-writer lock."""
+
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """Lets many readers or a single writer in at a time.
+
+    Waiting writers are preferred over new readers, so a steady stream of
+    requests cannot hold off a block from being appended. Both sides are
+    reentrant, and the writer may also read, but a reader cannot upgrade
+    to a writer.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__readers = 0
+        self.__writer = None
+        self.__write_depth = 0
+        self.__waiting_writers = 0
+        self.__local = threading.local()
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = getattr(self.__local, 'depth', 0)
+        if depth or self.__writer == me:
+            self.__local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.__local.depth = depth
+            return
+        with self.__condition:
+            while self.__writer is not None or self.__waiting_writers:
+                self.__condition.wait()
+            self.__readers += 1
+        self.__local.depth = 1
+        try:
+            yield
+        finally:
+            self.__local.depth = 0
+            with self.__condition:
+                self.__readers -= 1
+                if not self.__readers:
+                    self.__condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.__condition:
+            if self.__writer != me:
+                if getattr(self.__local, 'depth', 0):
+                    raise RuntimeError('Cannot upgrade a read lock to a write lock')
+                self.__waiting_writers += 1
+                try:
+                    while self.__writer is not None or self.__readers:
+                        self.__condition.wait()
+                finally:
+                    self.__waiting_writers -= 1
+                self.__writer = me
+            self.__write_depth += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__write_depth -= 1
+                if not self.__write_depth:
+                    self.__writer = None
+                    self.__condition.notify_all()
@@ -1,36 +1,177 @@
 """Provides verification helper methods."""
 
-from utility.hash_util import hash_string_256, hash_block
-from users import User
+from metrics import Histogram
+from utility.hash_util import hash_string_256, hash_block, hash_header
+from utility.mining import header_prefix
+from utility.process_pool import WORKERS, get_executor
+from users import User, verify_signature
+
+SEGMENT_SIZE = 256
+
+VERIFY_SECONDS = Histogram('verification_seconds', 'Time spent verifying chains, headers and transfers.',
+                           ['check'])
+
+
+def _verify_signatures(transfers):
+    return [verify_signature(tx.sender, tx.recipient, tx.file_name, tx.file_hash, tx.signature)
+            for tx in transfers]
+
+
+def verify_segment(blocks, verify_transfers=_verify_signatures):
+    """Checks the links, proofs and transfer signatures of ``blocks[1:]``,
+    with ``blocks[0]`` as the already verified anchor.
+
+    Returns the position of the first invalid block in ``blocks`` or
+    None. Runs in the worker processes of ``Verification.find_invalid_block``.
+    """
+    for position in range(1, len(blocks)):
+        block = blocks[position]
+        if block.previous_hash != hash_block(blocks[position - 1]):
+            return position
+        if not Verification.valid_version(blocks[position - 1], block):
+            return position
+        if not Verification.valid_block_proof(block):
+            return position
+        if not Verification.valid_reward(block.transfers):
+            return position
+        if not Verification.has_unique_signatures(block.transfers):
+            return position
+        if block.version != 0 and not all(verify_transfers(block.transfers[:-1])):
+            return position
+    return None
 
 
 class Verification:
     @staticmethod
-    def valid_proof(transfers, last_hash, proof):
-        guess = (str([tx.to_ordered_dict() for tx in transfers]) + str(last_hash) + str(proof)).encode()
+    def valid_header_proof(header):
+        guess = header_prefix(header) + str(header['proof']).encode()
         guess_hash = hash_string_256(guess)
         return guess_hash[0:2] == '00'
 
     @classmethod
-    def verify_chain(cls, blockchain):
+    def valid_block_proof(cls, block):
+        """Checks the proof of work of a block according to its version.
+
+        Version 1 blocks also have to match their Merkle root, which ties
+        the proven header to the transfers. The proof (and the signatures)
+        of a version 0 block covered the base64 payloads that were moved to
+        the blob store, so it is legacy history that only has to link up by
+        the hash recorded locally (see ``Storage.load_chain``); peers can
+        never send version 0 blocks.
+        """
+        if block.version == 0:
+            return True
+        return (block.merkle_root == block.compute_merkle_root() and
+                cls.valid_header_proof(block.header()))
+
+    @staticmethod
+    def valid_version(previous, block):
+        """Tells whether ``block`` may follow ``previous``: versions never
+        go down, so legacy version 0 blocks only make up the start of a
+        chain."""
+        return block.version >= previous.version
+
+    @staticmethod
+    def valid_reward(transfers):
+        """Tells whether the last of a block's ``transfers``, and only that
+        one, is the mining reward sent by ``SYSTEM``. Every other transfer
+        needs a valid signature."""
+        return (bool(transfers) and transfers[-1].sender == 'SYSTEM' and
+                all(tx.sender != 'SYSTEM' for tx in transfers[:-1]))
+
+    @staticmethod
+    def has_unique_signatures(transfers):
+        """Tells whether no signed transfer in ``transfers`` appears twice."""
+        signatures = [tx.signature for tx in transfers if tx.sender != 'SYSTEM']
+        return len(set(signatures)) == len(signatures)
+
+    @classmethod
+    @VERIFY_SECONDS.time(check='chain')
+    def verify_chain(cls, blockchain, trusted_height=0):
+        """Checks that the blocks link up and carry valid proofs.
+
+        Blocks up to ``trusted_height`` were verified before (see the
+        checkpoints in Blockchain) and only have their links checked.
+        """
         for (index, block) in enumerate(blockchain):
             if index == 0:
                 continue
             if block.previous_hash != hash_block(blockchain[index - 1]):
                 return False
-            if not cls.valid_proof(block.transfers[:-1], block.previous_hash, block.proof):
+            if block.index <= trusted_height:
+                continue
+            if not cls.valid_version(blockchain[index - 1], block):
+                print('Block version is invalid')
+                return False
+            if not cls.valid_block_proof(block):
                 print('Proof of work is invalid')
                 return False
+            if not cls.valid_reward(block.transfers):
+                print('Mining reward is invalid')
+                return False
         return True
 
     @staticmethod
-    def verify_transfer(transfer, get_balance, check_funds=True):
-        if check_funds:
-            sender_balance = get_balance(transfer.sender)
-            return sender_balance >= transfer.file and User.verify_transfer(transfer)
+    @VERIFY_SECONDS.time(check='segments')
+    def find_invalid_block(blocks, on_progress=None, segment_size=SEGMENT_SIZE):
+        """Fully verifies ``blocks[1:]`` on top of the trusted ``blocks[0]``.
+
+        The blocks are split into segments of ``segment_size`` that are
+        checked on the process pool, see ``verify_segment``. Results are
+        taken in chain order and ``on_progress`` is called with the last
+        block of every segment that verified, so an interrupted run can
+        resume from there. Returns the index of the first invalid block or
+        None if all of them are valid.
+        """
+        segments = [blocks[start - 1:start + segment_size]
+                    for start in range(1, len(blocks), segment_size)]
+        if len(segments) > 1 and WORKERS > 1:
+            executor = get_executor()
+            results = [executor.submit(verify_segment, segment) for segment in segments]
         else:
-            return User.verify_transfer(transfer)
+            results = None
+        for i, segment in enumerate(segments):
+            if results is None:
+                position = verify_segment(segment, User.verify_transfers)
+            else:
+                position = results[i].result()
+            if position is not None:
+                for future in results or ():
+                    future.cancel()
+                return segment[position].index
+            if on_progress is not None:
+                on_progress(segment[-1])
+        return None
 
     @classmethod
-    def verify_transfers(cls, open_transfers, get_balance):
-        return all([cls.verify_transfer(tx, get_balance, False) for tx in open_transfers])
+    @VERIFY_SECONDS.time(check='headers')
+    def verify_headers(cls, headers, last_hash):
+        """Checks that headers link up from ``last_hash`` and that their hash
+        and proof of work are valid.
+
+        Version 0 headers cannot be checked without the payloads their
+        hash covered, so a peer cannot send any.
+        """
+        for header in headers:
+            if header['previous_hash'] != last_hash:
+                return False
+            if header.get('version', 0) < 1:
+                return False
+            fields = {key: header[key] for key in
+                      ('index', 'previous_hash', 'timestamp', 'merkle_root', 'proof', 'version')}
+            if hash_header(fields) != header['hash']:
+                return False
+            if not cls.valid_header_proof(fields):
+                return False
+            last_hash = header['hash']
+        return True
+
+    @staticmethod
+    def is_contiguous(indices, start):
+        """Tells whether ``indices`` count up one by one from ``start``."""
+        return all(index == start + offset for offset, index in enumerate(indices))
+
+    @staticmethod
+    @VERIFY_SECONDS.time(check='transfers')
+    def verify_transfers(open_transfers, get_balance):
+        return all(User.verify_transfers(open_transfers))
@@ -0,0 +1,135 @@
+"""Compact binary encoding for messages between nodes.
+
+A message is its JSON metadata followed by the raw bytes of the files it
+carries, so payloads are neither base64 encoded nor parsed as JSON::
+
+    b'BCW1'
+    u32 metadata length, u32 file count
+    metadata (compact UTF-8 JSON)
+    per file: 32 byte SHA-256 digest, u64 length, content
+
+All integers are big endian. Browsers keep talking JSON; nodes send this
+format with ``CONTENT_TYPE`` and fall back to JSON for peers that answer
+415 Unsupported Media Type.
+"""
+
+import base64
+import json
+import os
+import struct
+
+CONTENT_TYPE = 'application/x-blockchain-wire'
+MAGIC = b'BCW1'
+CHUNK_SIZE = 3 * 16 * 1024
+
+_HEADER = struct.Struct('>4sII')
+_FILE_HEADER = struct.Struct('>32sQ')
+
+
+def decode(body):
+    """Returns ``(values, files)`` of an encoded message.
+
+    The files are memoryviews into ``body`` rather than copies. Raises
+    ValueError if the message is malformed.
+    """
+    view = memoryview(body)
+    if len(view) < _HEADER.size:
+        raise ValueError('Message is too short')
+    magic, meta_size, file_count = _HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('Unknown message format')
+    offset = _HEADER.size
+    values = json.loads(bytes(view[offset:offset + meta_size]).decode('utf-8'))
+    offset += meta_size
+    files = {}
+    for _ in range(file_count):
+        if offset + _FILE_HEADER.size > len(view):
+            raise ValueError('Message is truncated')
+        digest, size = _FILE_HEADER.unpack_from(view, offset)
+        offset += _FILE_HEADER.size
+        if offset + size > len(view):
+            raise ValueError('Message is truncated')
+        files[digest.hex()] = view[offset:offset + size]
+        offset += size
+    if offset != len(view) or not isinstance(values, dict):
+        raise ValueError('Message is malformed')
+    return values, files
+
+
+def read_chunks(path, encode=None):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk if encode is None else encode(chunk)
+
+
+class Body:
+    """A request body of known length that is streamed from ``chunks()``.
+
+    It can be iterated, i.e. sent, more than once, and requests sends it
+    with a ``Content-Length`` instead of chunked.
+    """
+
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.chunks()
+
+
+class Message:
+    """A message for peers that can be sent in either encoding.
+
+    ``files`` maps digests to the paths of the payloads, which are read in
+    chunks while the message is sent instead of being held in memory.
+    ``file_key`` is the JSON field the base64 payloads go in: ``'files'``
+    maps digests to payloads, ``'file'`` holds the payload of a single
+    file.
+    """
+
+    def __init__(self, values, files, file_key='files'):
+        self.values = values
+        self.files = files
+        self.file_key = file_key
+
+    def encode(self):
+        """Returns the message in the binary format as a Body."""
+        meta = json.dumps(self.values, separators=(',', ':')).encode('utf-8')
+        sizes = {file_hash: os.path.getsize(path) for file_hash, path in self.files.items()}
+        length = _HEADER.size + len(meta) + sum(_FILE_HEADER.size + size for size in sizes.values())
+
+        def chunks():
+            yield _HEADER.pack(MAGIC, len(meta), len(self.files)) + meta
+            for file_hash, path in self.files.items():
+                yield _FILE_HEADER.pack(bytes.fromhex(file_hash), sizes[file_hash])
+                yield from read_chunks(path)
+        return Body(chunks, length)
+
+    def to_json(self):
+        """Returns the message as a JSON Body with base64 payloads."""
+        values = {key: value for key, value in self.values.items() if key != self.file_key}
+        head = json.dumps(values)[:-1] + (', ' if values else '') + json.dumps(self.file_key) + ': '
+        if self.file_key == 'file':
+            paths = list(self.files.values())[:1]
+            keys = [b''] * len(paths)
+            opening, closing = (b'', b'}') if paths else (b'null', b'}')
+        else:
+            paths = list(self.files.values())
+            keys = [json.dumps(file_hash).encode() + b': ' for file_hash in self.files]
+            opening, closing = b'{', b'}}'
+        head = head.encode() + opening
+        prefixes = [(b', ' if position else b'') + key + b'"' for position, key in enumerate(keys)]
+        length = len(head) + len(closing) + sum(len(prefix) + 4 * -(-os.path.getsize(path) // 3) + 1
+                                                for prefix, path in zip(prefixes, paths))
+
+        def chunks():
+            yield head
+            for prefix, path in zip(prefixes, paths):
+                yield prefix
+                yield from read_chunks(path, base64.b64encode)
+                yield b'"'
+            yield closing
+        return Body(chunks, length)